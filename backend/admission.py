@@ -0,0 +1,192 @@
+import os
+import io
+import asyncio
+import base64
+import binascii
+import tempfile
+from contextlib import asynccontextmanager
+from typing import BinaryIO, Tuple
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))  # Encoded file size
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(30_000_000)))  # ~30 MP
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))  # Whole HTTP body
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))  # Spill to disk past this
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(768 * 1024 * 1024)))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "30"))  # seconds to wait for budget
+
+# Rough peak bytes per pixel while an image is in flight: decoded BGR + RGB copy,
+# mask and morphology buffers, PIL copies for resizing and compositing.
+IMAGE_MEMORY_FACTOR = int(os.getenv("IMAGE_MEMORY_FACTOR", "12"))
+# Of that, what a request keeps while it waits for its model turn: the RGB original and its mask
+IMAGE_HELD_FACTOR = 4
+# Masks are single-channel: the decoded L image plus its resized copy
+MASK_MEMORY_FACTOR = 2
+
+CHUNK_SIZE = 64 * 1024
+
+# Make PIL refuse decompression bombs on its own as well
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+def _too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+# --- Size Checks ---
+
+def probe_image(fileobj: BinaryIO) -> Tuple[int, int]:
+    """Read width/height from the image header without decoding pixels."""
+    fileobj.seek(0)
+    try:
+        with Image.open(fileobj) as img:
+            width, height = img.size
+    except Image.DecompressionBombError:
+        raise _too_large(f"Image exceeds {MAX_IMAGE_PIXELS} pixels")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    finally:
+        fileobj.seek(0)
+
+    check_image_pixels(width, height)
+    return width, height
+
+
+def check_image_pixels(width: int, height: int):
+    if width <= 0 or height <= 0:
+        raise HTTPException(status_code=400, detail="Invalid image dimensions")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise _too_large(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+
+
+def estimate_decoded_bytes(width: int, height: int) -> int:
+    return width * height * IMAGE_MEMORY_FACTOR
+
+
+def estimate_held_bytes(width: int, height: int) -> int:
+    return width * height * min(IMAGE_HELD_FACTOR, IMAGE_MEMORY_FACTOR)
+
+
+def estimate_mask_bytes(width: int, height: int) -> int:
+    return width * height * MASK_MEMORY_FACTOR
+
+
+async def spool_upload(file: UploadFile) -> BinaryIO:
+    """Copy an upload into a spooled temp file, enforcing MAX_UPLOAD_BYTES as we go."""
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD)
+    total = 0
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            spool.close()
+            raise _too_large(f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def decode_base64_image(data: str) -> bytes:
+    """Decode a base64 image (data URL header allowed), rejecting oversized payloads first."""
+    if "," in data:
+        data = data.split(",", 1)[1]
+    # 4 base64 chars -> 3 bytes; check before allocating the decoded buffer
+    if len(data) * 3 // 4 > MAX_UPLOAD_BYTES:
+        raise _too_large(f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid base64 image")
+
+
+def probe_image_bytes(image_bytes: bytes) -> Tuple[int, int]:
+    return probe_image(io.BytesIO(image_bytes))
+
+
+# --- Memory Budget ---
+
+class MemoryBudget:
+    """Async semaphore counted in bytes; image requests reserve their estimated decoded size."""
+
+    def __init__(self, total_bytes: int = MEMORY_BUDGET_BYTES, timeout: float = ADMISSION_TIMEOUT):
+        self.total_bytes = total_bytes
+        self.timeout = timeout
+        self.in_use = 0
+        self._condition = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def check(self, nbytes: int):
+        """413 for a request that could never fit, even split across nested reservations."""
+        if nbytes > self.total_bytes:
+            raise _too_large("Image is too large to process on this server")
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        self.check(nbytes)
+
+        condition = self._get_condition()
+        async with condition:
+            try:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.in_use + nbytes <= self.total_bytes),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is busy processing other images, please retry",
+                    headers={"Retry-After": "5"},
+                )
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            async with condition:
+                self.in_use -= nbytes
+                condition.notify_all()
+
+
+# --- Request Body Limit ---
+
+class BodySizeLimitMiddleware:
+    """Reject request bodies over MAX_REQUEST_BYTES before they are buffered."""
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                await send({
+                    "type": "http.response.start",
+                    "status": 413,
+                    "headers": [(b"content-type", b"application/json")],
+                })
+                await send({"type": "http.response.body", "body": b'{"detail":"Request body too large"}'})
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise _too_large("Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
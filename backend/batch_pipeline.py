@@ -0,0 +1,285 @@
+"""Offline batch smile design for directories of patient photos.
+
+Usage:
+    python batch_pipeline.py photos/ -o results/
+    python batch_pipeline.py cases.jsonl -o results/ --workers 8 --concurrency 4
+
+Decoding and masking run on a process pool, model calls on a bounded thread pool.
+Progress is appended to <output>/manifest.jsonl; rerunning the same command skips
+completed items and retries failed ones.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+# Per-process ImageProcessor, created once by the pool initializer
+_processor = None
+
+
+def _init_worker():
+    global _processor
+    from image_processing import ImageProcessor
+    _processor = ImageProcessor()
+
+
+def _load_rgb(path: str):
+    # Same decode as GenerativeService.load_image, so mask and model input line up on rotated photos
+    from PIL import Image, ImageOps
+    with open(path, "rb") as f:
+        return ImageOps.exif_transpose(Image.open(f)).convert("RGB")
+
+
+def mask_job(path: str) -> dict:
+    """Decode + landmark + mask in a worker process. Returns only the encoded mask."""
+    import numpy as np
+
+    t0 = time.perf_counter()
+    image = np.asarray(_load_rgb(path))
+    landmarks = _processor.detect_landmarks(image, rgb=True)
+    mask = _processor.build_mask(landmarks)
+    return {
+        "mask": _processor.encode_mask(mask),
+        "width": landmarks["width"],
+        "height": landmarks["height"],
+        "seconds": time.perf_counter() - t0,
+    }
+
+
+# --- Inputs & Manifest ---
+
+def _safe_relpath(item_id: str) -> str:
+    """Relative path for an item id that can't leave the output directory (absolute or ../ ids)."""
+    parts = [part for part in item_id.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    if parts and parts[0].endswith(":"):
+        parts = parts[1:]  # Windows drive letter
+    return os.path.join(*parts) if parts else "item"
+
+
+def collect_items(source: str) -> list:
+    """Items from a directory walk, or from a manifest (one path per line, or JSONL with "path")."""
+    items = []
+    if os.path.isdir(source):
+        for dirpath, _, filenames in os.walk(source):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(dirpath, filename)
+                    items.append({"id": os.path.relpath(path, source), "path": path})
+        items.sort(key=lambda item: item["id"])
+        return items
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line) if line.startswith("{") else {"path": line}
+            item.setdefault("id", item["path"])
+            if not os.path.isabs(item["path"]):
+                item["path"] = os.path.join(base_dir, item["path"])
+            items.append(item)
+    return items
+
+
+class Manifest:
+    """Append-only JSONL log of item outcomes; the last entry per id wins."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from an interrupted run
+                    self.entries[entry["id"]] = entry
+        self._file = open(path, "a")
+
+    def is_done(self, item_id: str) -> bool:
+        entry = self.entries.get(item_id)
+        return entry is not None and entry["status"] == "done"
+
+    def record(self, entry: dict):
+        self.entries[entry["id"]] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# --- Pipeline ---
+
+class BatchPipeline:
+    def __init__(self, output_dir: str, workers: int, concurrency: int, max_retries: int,
+                 style_prompt: str = None, expert_prompt: str = None):
+        from generative_service import GenerativeService
+
+        self.output_dir = output_dir
+        self.workers = workers
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.style_prompt = style_prompt
+        self.expert_prompt = expert_prompt
+        self.gen_service = GenerativeService()
+        self.timings = {"mask": [], "model": [], "write": []}
+        self.completed = 0
+        self.failed = 0
+
+    def output_path(self, item: dict) -> str:
+        stem = os.path.splitext(_safe_relpath(item["id"]))[0]
+        return os.path.join(self.output_dir, f"{stem}_smile.png")
+
+    def generate(self, item: dict, mask_base64: str) -> str:
+        import io
+        from PIL import Image
+        from generative_service import build_smile_prompt
+
+        with open(item["path"], "rb") as f:
+            original_image, model_image = self.gen_service.load_image(f)
+        mask_image = Image.open(io.BytesIO(base64.b64decode(mask_base64)))
+        inputs = self.gen_service.prepare_inputs(original_image, mask_image, model_image)
+        prompt = build_smile_prompt(
+            item.get("style_prompt", self.style_prompt),
+            item.get("expert_prompt", self.expert_prompt),
+        )
+        return self.gen_service.run_edit(inputs, prompt)
+
+    async def handle(self, item, manifest, process_pool, model_pool, in_flight, model_slots, total):
+        # Held from masking until the result is written, so masks can't pile up ahead of the model stage
+        async with in_flight:
+            await self._handle(item, manifest, process_pool, model_pool, model_slots, total)
+
+    async def _handle(self, item, manifest, process_pool, model_pool, model_slots, total):
+        loop = asyncio.get_running_loop()
+        entry = {"id": item["id"], "path": item["path"], "timings": {}}
+
+        try:
+            mask_result = await loop.run_in_executor(process_pool, mask_job, item["path"])
+            entry["timings"]["mask"] = mask_result["seconds"]
+            self.timings["mask"].append(mask_result["seconds"])
+        except Exception as e:
+            # Decode / face detection failures won't fix themselves on retry
+            self._finish(manifest, entry, "failed", total, error=f"mask: {e}")
+            return
+
+        for attempt in range(1, self.max_retries + 2):
+            entry["attempts"] = attempt
+            try:
+                async with model_slots:
+                    t0 = time.perf_counter()
+                    result_url = await loop.run_in_executor(model_pool, self.generate, item, mask_result["mask"])
+                    entry["timings"]["model"] = time.perf_counter() - t0
+                self.timings["model"].append(entry["timings"]["model"])
+                break
+            except Exception as e:
+                if attempt > self.max_retries:
+                    self._finish(manifest, entry, "failed", total, error=f"model: {e}")
+                    return
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+        t0 = time.perf_counter()
+        output_path = self.output_path(item)
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            await loop.run_in_executor(model_pool, _write_data_url, output_path, result_url)
+        except Exception as e:
+            # e.g. a name too long for the filesystem; fail this item, not the whole run
+            self._finish(manifest, entry, "failed", total, error=f"write: {e}")
+            return
+        entry["timings"]["write"] = time.perf_counter() - t0
+        self.timings["write"].append(entry["timings"]["write"])
+        entry["output"] = output_path
+        self._finish(manifest, entry, "done", total)
+
+    def _finish(self, manifest, entry, status, total, error=None):
+        entry["status"] = status
+        if error:
+            entry["error"] = error
+            self.failed += 1
+        else:
+            self.completed += 1
+        manifest.record(entry)
+        timings = ", ".join(f"{k} {v:.1f}s" for k, v in entry["timings"].items())
+        print(f"[{self.completed + self.failed}/{total}] {status}: {entry['id']} ({timings}){' - ' + error if error else ''}")
+
+    async def run(self, items: list, manifest: Manifest):
+        pending = [item for item in items if not manifest.is_done(item["id"])]
+        skipped = len(items) - len(pending)
+        print(f"{len(items)} items, {skipped} already done, {len(pending)} to process.")
+        if not pending:
+            return
+
+        # Enough items in flight to keep every model slot busy with the next masks ready
+        in_flight = asyncio.Semaphore(self.concurrency + self.workers)
+        model_slots = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        # spawn: this process already holds Vertex AI / gRPC threads, which must not be forked
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=spawn, initializer=_init_worker) as process_pool, \
+                ThreadPoolExecutor(max_workers=self.concurrency + 2) as model_pool:
+            await asyncio.gather(*(
+                self.handle(item, manifest, process_pool, model_pool, in_flight, model_slots, len(pending))
+                for item in pending
+            ))
+        self.report(time.perf_counter() - started)
+
+    def report(self, elapsed: float):
+        print(f"\nDone in {elapsed:.1f}s: {self.completed} completed, {self.failed} failed, "
+              f"{self.completed / elapsed if elapsed else 0:.2f} images/s")
+        for stage, values in self.timings.items():
+            if not values:
+                continue
+            values = sorted(values)
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            print(f"  {stage:<6} n={len(values):<6} mean={statistics.mean(values):.2f}s "
+                  f"p50={statistics.median(values):.2f}s p95={p95:.2f}s")
+
+
+def _write_data_url(path: str, data_url: str):
+    data = data_url.split(",", 1)[1] if data_url.startswith("data:") else data_url
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(base64.b64decode(data))
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch smile design for a directory or manifest of photos.")
+    parser.add_argument("input", help="Directory of images, or a manifest (paths per line, or JSONL with 'path')")
+    parser.add_argument("-o", "--output", required=True, help="Output directory (manifest.jsonl is kept here)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes for decode + masking")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent model calls")
+    parser.add_argument("--max-retries", type=int, default=2, help="Retries per item for model errors")
+    parser.add_argument("--style-prompt", default=None)
+    parser.add_argument("--expert-prompt", default=None)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    items = collect_items(args.input)
+    manifest = Manifest(os.path.join(args.output, "manifest.jsonl"))
+    pipeline = BatchPipeline(
+        args.output, args.workers, args.concurrency, args.max_retries,
+        style_prompt=args.style_prompt, expert_prompt=args.expert_prompt,
+    )
+    try:
+        asyncio.run(pipeline.run(items, manifest))
+    finally:
+        manifest.close()
+    return 1 if pipeline.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
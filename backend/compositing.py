@@ -0,0 +1,46 @@
+import numpy as np
+from PIL import Image
+from typing import Optional, Tuple
+
+
+def mask_bbox(alpha: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box (x0, y0, x1, y1) of the non-zero mask pixels, or None for an empty mask."""
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(alpha.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def composite_roi(original: Image.Image, generated: Image.Image, mask: Image.Image) -> Image.Image:
+    """Blend the model output into the full-resolution original, touching only the mask's bounding box.
+
+    `generated` may be smaller than `original` (the model runs on a downscaled copy); only the
+    region under the mask is upscaled. `mask` must already match `original`'s size.
+    """
+    result = np.array(original.convert("RGB"))  # Full-res copy, left untouched outside the ROI
+    alpha = np.asarray(mask.convert("L"))
+
+    bbox = mask_bbox(alpha)
+    if bbox is None:
+        return Image.fromarray(result)
+    x0, y0, x1, y1 = bbox
+
+    # Upscale just the matching region of the model output, using a float source box
+    # so the crop lines up exactly with the original pixels
+    scale_x = generated.width / original.width
+    scale_y = generated.height / original.height
+    gen_roi = generated.convert("RGB").resize(
+        (x1 - x0, y1 - y0),
+        Image.LANCZOS,
+        box=(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y),
+    )
+
+    # Integer alpha blend, same weighting as Image.composite: gen * a + base * (255 - a)
+    a = alpha[y0:y1, x0:x1, None].astype(np.uint16)
+    base = result[y0:y1, x0:x1].astype(np.uint16)
+    gen = np.asarray(gen_roi, dtype=np.uint16)
+    blended = (gen * a + base * (255 - a) + 127) // 255
+    result[y0:y1, x0:x1] = blended.astype(np.uint8)
+
+    return Image.fromarray(result)
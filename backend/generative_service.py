@@ -2,7 +2,8 @@ import os
 import base64
 import io
 import json
-from PIL import Image
+from PIL import Image, ImageOps
+from compositing import composite_roi
 from dotenv import load_dotenv
 import vertexai
 from vertexai.preview.vision_models import ImageGenerationModel
@@ -10,6 +11,21 @@ from google.oauth2 import service_account
 
 load_dotenv()
 
+def build_smile_prompt(style_prompt: str = None, expert_prompt: str = None, prompt: str = None) -> str:
+    full_prompt = f"""
+Act as an expert dental aesthetician and professional photographer.
+Task: Redesign the smile with high-quality porcelain laminate veneers.
+1. Camera & Lighting: Macro dental photography, 100mm macro lens, soft studio lighting, 8k resolution, hyperrealistic texture.
+2. Teeth Design: Apply {style_prompt if style_prompt else "natural ivory white veneers with translucent enamel texture"}. Ensure realistic light reflections, slight surface texture (perikymata), and natural optical properties.
+3. Lip Harmonization: You MUST adjust the lip structure to fit the new teeth perfectly. Subtly lift the upper lip or reshape the lower lip to create a natural smile line. The teeth must sit naturally behind the lips, not on top of them.
+4. Integration: The result must be indistinguishable from a real photo. Blend the new smile seamlessly with the facial expression and beard.
+5. Details: {expert_prompt if expert_prompt else "Perfect anatomical fit, golden ratio proportions, healthy pink gingiva."}
+"""
+    # If legacy prompt is provided and no new fields, fallback to it (or append it)
+    if prompt and not style_prompt:
+        full_prompt += f"\n[ADDITIONAL]: {prompt}"
+    return full_prompt
+
 class GenerativeService:
     def __init__(self):
         # Initialize Vertex AI
@@ -56,47 +72,85 @@ class GenerativeService:
                 print(f"Failed to load Imagen 2 model: {e2}")
                 self.model = None
 
-    def generate_smile(self, image_base64: str, mask_base64: str = None, prompt: str = "", negative_prompt: str = "") -> str:
-        if not self.model:
-            raise ValueError("Vertex AI Model not initialized.")
+    # OOM Protection: the model only sees a downscaled copy (max 1280px).
+    # The original stays at full resolution for compositing.
+    MAX_MODEL_DIMENSION = 1280
 
-        print(f"Generating smile with prompt: {prompt}")
+    def model_sized(self, original_image: Image.Image) -> Image.Image:
+        if original_image.width <= self.MAX_MODEL_DIMENSION and original_image.height <= self.MAX_MODEL_DIMENSION:
+            return original_image
+        base_image = original_image.copy()
+        base_image.thumbnail((self.MAX_MODEL_DIMENSION, self.MAX_MODEL_DIMENSION), Image.LANCZOS)
+        print(f"Resized model input to {base_image.size} for stability.")
+        return base_image
 
-        # Decode images
-        image_bytes = base64.b64decode(image_base64)
-        base_image = Image.open(io.BytesIO(image_bytes))
-        
-        # OOM Protection: Resize if image is too large (max 1280px)
-        max_dimension = 1280
-        if base_image.width > max_dimension or base_image.height > max_dimension:
-            base_image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
-            print(f"Resized image to {base_image.size} for stability.")
-            
-            # Update image_bytes for VertexImage
+    def load_image(self, fileobj) -> tuple:
+        """Decode an upload once. Returns (full-res RGB original, model-sized copy)."""
+        original_image = ImageOps.exif_transpose(Image.open(fileobj)).convert("RGB")
+        return original_image, self.model_sized(original_image)
+
+    def prepare_inputs(self, original_image: Image.Image, mask_image: Image.Image = None,
+                       base_image: Image.Image = None, image_bytes: bytes = None) -> dict:
+        """Encode the model-sized image and mask for Vertex AI.
+
+        `image_bytes` (the original upload) is sent as-is when no downscaling was needed.
+        """
+        if base_image is None:
+            base_image = self.model_sized(original_image)
+        if base_image is not original_image or image_bytes is None:
             buf = io.BytesIO()
             base_image.save(buf, format="PNG")
             image_bytes = buf.getvalue()
 
-        # Convert to Vertex AI Image format
-        from vertexai.preview.vision_models import Image as VertexImage
-        v_base_image = VertexImage(image_bytes)
-        
-        v_mask_image = None
-        if mask_base64:
-            mask_bytes = base64.b64decode(mask_base64)
-            mask_image = Image.open(io.BytesIO(mask_bytes))
+        mask_bytes = None
+        if mask_image is not None:
+            mask_image = mask_image.convert('L')
+            # Full-res mask for compositing, model-res mask for Vertex
+            if mask_image.size != original_image.size:
+                mask_image = mask_image.resize(original_image.size, Image.NEAREST)
+            model_mask = mask_image
+            if model_mask.size != base_image.size:
+                model_mask = mask_image.resize(base_image.size, Image.NEAREST)
+                print(f"Resized mask to {model_mask.size} to match model input.")
             
-            # Resize mask to match base_image if needed
-            if mask_image.size != base_image.size:
-                mask_image = mask_image.resize(base_image.size, Image.NEAREST)
-                print(f"Resized mask to {mask_image.size} to match image.")
-            
-            # Update mask_bytes for VertexImage
             mask_buf = io.BytesIO()
-            mask_image.save(mask_buf, format="PNG")
+            model_mask.save(mask_buf, format="PNG")
             mask_bytes = mask_buf.getvalue()
-            
-            v_mask_image = VertexImage(mask_bytes)
+
+        return {
+            "original_image": original_image,
+            "mask_image": mask_image,
+            "image_bytes": image_bytes,
+            "mask_bytes": mask_bytes,
+        }
+
+    def decode_inputs(self, image_base64: str, mask_base64: str = None) -> dict:
+        """Decode base64 image and mask and prepare them for run_edit."""
+        image_bytes = base64.b64decode(image_base64)
+        original_image = Image.open(io.BytesIO(image_bytes))
+        
+        mask_image = None
+        if mask_base64:
+            mask_image = Image.open(io.BytesIO(base64.b64decode(mask_base64)))
+
+        return self.prepare_inputs(original_image, mask_image, image_bytes=image_bytes)
+
+    def generate_smile(self, image_base64: str, mask_base64: str = None, prompt: str = "", negative_prompt: str = "") -> str:
+        if not self.model:
+            raise ValueError("Vertex AI Model not initialized.")
+        return self.run_edit(self.decode_inputs(image_base64, mask_base64), prompt, negative_prompt)
+
+    def run_edit(self, inputs: dict, prompt: str = "", negative_prompt: str = "") -> str:
+        """Call Vertex AI with prepared inputs and composite the result. Returns a PNG data URL."""
+        if not self.model:
+            raise ValueError("Vertex AI Model not initialized.")
+
+        print(f"Generating smile with prompt: {prompt}")
+
+        # Convert to Vertex AI Image format
+        from vertexai.preview.vision_models import Image as VertexImage
+        v_base_image = VertexImage(inputs["image_bytes"])
+        v_mask_image = VertexImage(inputs["mask_bytes"]) if inputs["mask_bytes"] else None
 
         try:
             # Edit Image
@@ -123,20 +177,17 @@ class GenerativeService:
                 # If we used a mask, we do High-Res Blending.
                 # If we did NOT use a mask (mask-free), we return the generated image directly
                 # because the AI edited the whole image (or parts of it) and we don't have a mask to blend back.
-                if mask_base64:
-                    # High-Res Blending Logic
-                    if gen_img_pil.size != base_image.size:
-                        gen_img_pil = gen_img_pil.resize(base_image.size, Image.LANCZOS)
-
-                    mask_pil = mask_image.convert('L')
-                    final_image = Image.composite(gen_img_pil, base_image, mask_pil)
+                if inputs["mask_image"] is not None:
+                    # High-Res Blending Logic: upscale and blend only inside the mask's bounding box,
+                    # on top of the untouched original-resolution photo
+                    final_image = composite_roi(inputs["original_image"], gen_img_pil, inputs["mask_image"])
                 else:
                     # Mask-Free: Return result directly (AI handled blending)
                     final_image = gen_img_pil
                 
                 # Convert result to base64
                 output_buffer = io.BytesIO()
-                final_image.save(output_buffer, format="PNG")
+                final_image.save(output_buffer, format="PNG", compress_level=3) # Full-res output, favour encode speed
                 output_base64 = base64.b64encode(output_buffer.getvalue()).decode('utf-8')
                 
                 return f"data:image/png;base64,{output_base64}"
@@ -0,0 +1,39 @@
+# Production serving: gunicorn -c gunicorn.conf.py main:app
+import os
+
+from dotenv import load_dotenv
+
+# Load .env before anything reads the limits the worker count is derived from
+load_dotenv()
+
+from runtime import available_cpus, web_concurrency, cpu_pool_size
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = web_concurrency()
+# The app splits per-container limits (memory budget, quotas, model concurrency) across
+# this many workers, see runtime.worker_processes()
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+# Import main.py once in the master so static files, libraries and the DB schema
+# are loaded before fork and shared copy-on-write. Per-worker services start on app startup.
+preload_app = True
+
+timeout = int(os.getenv("WORKER_TIMEOUT", "180"))  # Model calls can take a while
+graceful_timeout = 30  # Time to flush queued generation records on shutdown
+keepalive = 5
+# Only trust X-Forwarded-For from the proxy in front of us; anonymous quotas are keyed on the
+# client IP it yields. Set FORWARDED_ALLOW_IPS to the proxy's address range (CIDRs allowed).
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def when_ready(server):
+    server.log.info(
+        f"{available_cpus()} CPUs available: {workers} workers x {cpu_pool_size()} image processes"
+    )
+
+
+def post_fork(server, worker):
+    # Never share DB connections opened in the master with the children
+    from database import engine
+    engine.dispose(close=False)
@@ -0,0 +1,286 @@
+import io
+import csv
+import json
+import hashlib
+import zipfile
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, case, literal
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Generation
+from persistence import read_blob_bytes, image_available
+
+# Rows fetched per round trip while streaming images; each row carries a full image
+IMAGE_FETCH_BATCH = 8
+
+# An archive's layout (total length plus size and CRC of every image entry) takes a full pass over
+# the images, so remember it for resumed downloads. Kept per process, keyed by user and ETag.
+_layout_cache: "OrderedDict[str, Tuple[int, Dict[int, Tuple[int, int]]]]" = OrderedDict()
+_layout_cache_lock = threading.Lock()
+_LAYOUT_CACHE_SIZE = 64
+
+_DATA_DESCRIPTOR_FLAG = 0x08  # Set by ZipFile on non-seekable output
+_DATA_DESCRIPTOR_SIZE = 16  # signature, CRC, compressed and uncompressed size (no ZIP64)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Non-seekable write target for ZipFile; collects (offset, chunk) pairs until they are drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append((self._position, bytes(data)))
+        self._position += len(data)
+        return len(data)
+
+    def skip(self, nbytes: int):
+        """Advance past bytes the client already has without producing them."""
+        self._position += nbytes
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _image_name(gen_id: int) -> str:
+    return f"images/{gen_id:06d}.png"
+
+
+def _file_name(gen_id: int, image_ref: Optional[str]) -> str:
+    """Archive path of a row's image, or "" when it has none to export."""
+    return _image_name(gen_id) if image_available(image_ref or "") else ""
+
+
+def _zip_info(name: str, created_at, compress_type: int) -> zipfile.ZipInfo:
+    # Fixed timestamps keep the archive byte-identical between requests, which Range relies on
+    info = zipfile.ZipInfo(name, date_time=created_at.timetuple()[:6])
+    info.compress_type = compress_type
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _stored_info(gen_id: int, created_at, size: int, crc: int) -> zipfile.ZipInfo:
+    """The ZipInfo ZipFile.writestr records for an image entry on non-seekable output."""
+    info = _zip_info(_image_name(gen_id), created_at, zipfile.ZIP_STORED)
+    info.flag_bits = _DATA_DESCRIPTOR_FLAG
+    info.CRC = crc
+    info.compress_size = info.file_size = size
+    return info
+
+
+def _stored_entry_length(info: zipfile.ZipInfo) -> int:
+    return len(info.FileHeader(False)) + info.file_size + _DATA_DESCRIPTOR_SIZE
+
+
+def _skip_entry(zf: zipfile.ZipFile, sink: _ChunkSink, info: zipfile.ZipInfo):
+    """Register an image entry in the central directory without reading or emitting its bytes."""
+    info.header_offset = sink.tell()
+    sink.skip(_stored_entry_length(info))
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf.start_dir = sink.tell()
+
+
+def snapshot(db: Session, user_id: int) -> Tuple[int, int, str]:
+    """Pin the export to the rows that exist now. Returns (max_id, count, etag)."""
+    max_id, count = db.query(func.max(Generation.id), func.count(Generation.id)).filter(
+        Generation.user_id == user_id
+    ).one()
+    max_id = max_id or 0
+    digest = hashlib.sha256(f"{user_id}:{max_id}:{count}".encode()).hexdigest()[:32]
+    return max_id, count, f'"{digest}"'
+
+
+def _archive_chunks(user_id: int, max_id: int, skip_before: int = 0,
+                    entries: Optional[Dict[int, Tuple[int, int]]] = None,
+                    cache_key: Optional[str] = None) -> Iterator[Tuple[int, bytes]]:
+    """Yield (offset, chunk) pairs of the ZIP archive; memory stays at roughly one image at a time.
+
+    With `entries` (image size and CRC by generation id, from a previous pass), image entries
+    that end before `skip_before` are accounted for without being read, so their bytes are
+    never produced. With `cache_key`, the layout is cached once the archive is complete.
+    """
+    db = SessionLocal()
+    sink = _ChunkSink()
+    layout: Dict[int, Tuple[int, int]] = {}
+    try:
+        base_query = db.query(Generation).filter(Generation.user_id == user_id, Generation.id <= max_id)
+        # Inline data URLs are collapsed to "data:" so these rows stay small
+        image_ref = case(
+            (Generation.generated_image_url.like("data:%"), literal("data:")),
+            else_=Generation.generated_image_url,
+        )
+        meta_query = base_query.with_entities(
+            Generation.id, Generation.prompt, Generation.created_at, image_ref
+        ).order_by(Generation.id)
+        newest = base_query.with_entities(func.max(Generation.created_at)).scalar()
+        archive_time = newest or datetime(1980, 1, 1)  # ZIP's earliest representable date
+
+        with zipfile.ZipFile(sink, mode="w") as zf:
+            # 1. Metadata (small columns only, streamed row by row)
+            with zf.open(_zip_info("metadata.csv", archive_time, zipfile.ZIP_DEFLATED), mode="w", force_zip64=True) as f:
+                text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+                writer = csv.writer(text)
+                writer.writerow(["id", "created_at", "prompt", "file"])
+                for gen_id, prompt, created_at, ref in meta_query.yield_per(500):
+                    writer.writerow([gen_id, created_at.isoformat(), prompt or "", _file_name(gen_id, ref)])
+                text.flush()
+                text.detach()
+            yield from sink.drain()
+
+            with zf.open(_zip_info("metadata.json", archive_time, zipfile.ZIP_DEFLATED), mode="w", force_zip64=True) as f:
+                f.write(b"[")
+                for i, (gen_id, prompt, created_at, ref) in enumerate(meta_query.yield_per(500)):
+                    row = {"id": gen_id, "created_at": created_at.isoformat(), "prompt": prompt, "file": _file_name(gen_id, ref)}
+                    f.write((b"," if i else b"") + b"\n" + json.dumps(row).encode("utf-8"))
+                f.write(b"\n]\n")
+            yield from sink.drain()
+
+            # 2. Images the client already has: sizes and CRCs from the layout, no image reads
+            first_id = 0
+            if entries and skip_before:
+                for gen_id, created_at, ref in meta_query.with_entities(
+                    Generation.id, Generation.created_at, image_ref
+                ).yield_per(500):
+                    if image_available(ref or ""):
+                        if gen_id not in entries:
+                            break
+                        info = _stored_info(gen_id, created_at, *entries[gen_id])
+                        if sink.tell() + _stored_entry_length(info) > skip_before:
+                            break
+                        _skip_entry(zf, sink, info)
+                        layout[gen_id] = entries[gen_id]
+                    first_id = gen_id + 1
+
+            # 3. Remaining images, one row at a time (PNG is already compressed, so store as-is)
+            image_query = base_query.filter(Generation.id >= first_id).with_entities(
+                Generation.id, Generation.created_at, Generation.generated_image_url
+            ).order_by(Generation.id)
+            for gen_id, created_at, image_url in image_query.yield_per(IMAGE_FETCH_BATCH):
+                if not image_available(image_url or ""):
+                    continue  # Placeholder or missing blob; metadata lists no file for it
+                data = read_blob_bytes(image_url)
+                zf.writestr(_zip_info(_image_name(gen_id), created_at, zipfile.ZIP_STORED), data)
+                info = zf.filelist[-1]
+                layout[gen_id] = (info.file_size, info.CRC)
+                yield from sink.drain()
+
+        # Central directory is written on close
+        yield from sink.drain()
+        if cache_key:
+            _store_layout(cache_key, sink.tell(), layout)
+    finally:
+        db.close()
+
+
+def iter_archive(user_id: int, max_id: int, cache_key: Optional[str] = None) -> Iterator[bytes]:
+    """Yield the whole ZIP archive in chunks."""
+    for _, chunk in _archive_chunks(user_id, max_id, cache_key=cache_key):
+        yield chunk
+
+
+def _store_layout(key: str, length: int, entries: Dict[int, Tuple[int, int]]):
+    with _layout_cache_lock:
+        _layout_cache[key] = (length, entries)
+        _layout_cache.move_to_end(key)
+        while len(_layout_cache) > _LAYOUT_CACHE_SIZE:
+            _layout_cache.popitem(last=False)
+
+
+def _cached_layout(key: str) -> Optional[Tuple[int, Dict[int, Tuple[int, int]]]]:
+    with _layout_cache_lock:
+        layout = _layout_cache.get(key)
+        if layout is not None:
+            _layout_cache.move_to_end(key)
+        return layout
+
+
+def archive_layout(user_id: int, max_id: int, etag: str) -> Tuple[int, Dict[int, Tuple[int, int]]]:
+    """(total length, {generation id: (image size, CRC)}), from cache or a dry run."""
+    key = f"{user_id}:{etag}"
+    layout = _cached_layout(key)
+    if layout is None:
+        for _ in _archive_chunks(user_id, max_id, cache_key=key):
+            pass
+        layout = _cached_layout(key)
+    return layout
+
+
+def _slice(chunks: Iterator[Tuple[int, bytes]], start: int, end: int) -> Iterator[bytes]:
+    """Yield only bytes [start, end] (inclusive) of an (offset, chunk) stream."""
+    for position, chunk in chunks:
+        chunk_end = position + len(chunk)
+        if chunk_end > start and position <= end:
+            yield chunk[max(start - position, 0):end - position + 1]
+        if chunk_end > end:
+            break
+
+
+def _parse_range(header: str, length: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=a-b" range. Returns None for ranges we serve as a full 200."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: last N bytes
+            start, end = max(length - int(last), 0), length - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None  # Malformed (e.g. bytes=5-2); ignored, so a full 200
+            end = min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if start > end or start >= length:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{length}"})
+    return start, end
+
+
+async def export_response(request: Request, user_id: int, db: Session) -> StreamingResponse:
+    max_id, _, etag = snapshot(db, user_id)
+    headers = {
+        "Content-Disposition": 'attachment; filename="smile-designs.zip"',
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    cache_key = f"{user_id}:{etag}"
+    if range_header and (not if_range or if_range == etag):
+        length, entries = await run_in_threadpool(archive_layout, user_id, max_id, etag)
+        byte_range = _parse_range(range_header, length)
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                # Resume without re-reading the images before `start`
+                _slice(_archive_chunks(user_id, max_id, skip_before=start, entries=entries), start, end),
+                status_code=206,
+                media_type="application/zip",
+                headers=headers,
+            )
+
+    cached = _cached_layout(cache_key)
+    if cached is not None:
+        headers["Content-Length"] = str(cached[0])
+    return StreamingResponse(iter_archive(user_id, max_id, cache_key=cache_key), media_type="application/zip", headers=headers)
@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Tuple
+
+from fastapi import HTTPException
+
+# Results are full-resolution PNG data URLs, so only keep them as long as a client retry needs
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))  # seconds a completed result is replayable
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "200"))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(256 * 1024 * 1024)))  # Stored results in total
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(payload: Any) -> str:
+    """Stable hash of a request payload, so a key can't be reused for a different request."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _approx_size(value: Any) -> int:
+    """Rough in-memory size of a JSON-like result, dominated by its image strings."""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_approx_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_approx_size(v) for v in value)
+    return 64
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "task", "expires_at", "size")
+
+    def __init__(self, fingerprint: str, task: "asyncio.Task"):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.expires_at = float("inf")  # Set once the computation succeeds
+        self.size = 0
+
+
+class IdempotencyStore:
+    """In-process store of in-flight and completed results keyed by Idempotency-Key.
+
+    Retries with the same key attach to the running computation or get the stored result
+    replayed. Failed computations are forgotten so the client can retry them. Stored results
+    are capped by count and total size; the oldest are dropped first.
+    State is per process: the caps are divided between web workers by the caller, and a
+    retry that lands on a different worker recomputes.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+                 max_bytes: int = IDEMPOTENCY_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stored_bytes = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    async def run(self, key: str, request_fingerprint: str,
+                  compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, replayed). `replayed` is True when no new computation was started."""
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+        self._evict(incoming=0 if key in self._entries else 1)
+        entry = self._entries.get(key)
+        replayed = entry is not None
+        if entry is not None:
+            if entry.fingerprint != request_fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used with a different request",
+                )
+        else:
+            task = asyncio.ensure_future(compute())
+            entry = _Entry(request_fingerprint, task)
+            self._entries[key] = entry
+            task.add_done_callback(lambda t, k=key: self._on_done(k, t))
+
+        # Shield so a client disconnect doesn't cancel work a retry may attach to
+        return await asyncio.shield(entry.task), replayed
+
+    def _on_done(self, key: str, task: "asyncio.Task"):
+        entry = self._entries.get(key)
+        if entry is None or entry.task is not task:
+            return
+        if task.cancelled() or task.exception() is not None:
+            # Don't cache failures; the next retry recomputes
+            self._drop(key)
+            return
+
+        size = _approx_size(task.result())
+        if size > self.max_bytes:
+            self._drop(key)  # Too big to keep; a retry recomputes
+            return
+        entry.size = size
+        entry.expires_at = time.monotonic() + self.ttl
+        self.stored_bytes += entry.size
+        self._evict()
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self.stored_bytes -= entry.size
+
+    def _evict(self, incoming: int = 0):
+        """Drop expired results, then the oldest ones until `incoming` new entries fit the caps."""
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.expires_at < now]:
+            self._drop(key)
+        # Over capacity: drop the oldest completed results, never in-flight ones
+        for key in list(self._entries):
+            if len(self._entries) + incoming <= self.max_entries and self.stored_bytes <= self.max_bytes:
+                break
+            if self._entries[key].task.done():
+                self._drop(key)
@@ -3,6 +3,14 @@ import mediapipe as mp
 import numpy as np
 import base64
 
+# Named mask settings for the /remask preset mode. "default" matches process_image.
+MASK_PRESETS = {
+    "tight": {"dilation": 15, "feather": 11, "include_lips": False, "include_gums": False},
+    "default": {"dilation": 40, "feather": 21, "include_lips": False, "include_gums": False},
+    "gums": {"dilation": 40, "feather": 21, "include_lips": False, "include_gums": True},
+    "wide": {"dilation": 60, "feather": 31, "include_lips": True, "include_gums": True},
+}
+
 class ImageProcessor:
     def __init__(self):
         self.mp_face_mesh = mp.solutions.face_mesh
@@ -19,17 +27,21 @@ class ImageProcessor:
             78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, # Upper inner
             324, 318, 402, 317, 14, 87, 178, 88, 95 # Lower inner (reversed to close loop)
         ]
-
-    def process_image(self, image_bytes: bytes) -> dict:
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         
-        if image is None:
-            raise ValueError("Could not decode image")
+        # Outer lip contour, used when the lips themselves should be masked
+        self.OUTER_LIPS_INDICES = [
+            61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, # Upper outer
+            375, 321, 405, 314, 17, 84, 181, 91, 146 # Lower outer (reversed to close loop)
+        ]
 
-        height, width, _ = image.shape
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    def detect_landmarks(self, image: np.ndarray, rgb: bool = False, size: tuple = None) -> dict:
+        """Run FaceMesh once and keep only the pixel polygons needed to rebuild masks.
+
+        Pass `size` (width, height) to detect on a downscaled copy but get coordinates for
+        the full-resolution image; FaceMesh works on a small input internally anyway.
+        """
+        width, height = size or (image.shape[1], image.shape[0])
+        rgb_image = image if rgb else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
         results = self.face_mesh.process(rgb_image)
         
@@ -38,36 +50,92 @@ class ImageProcessor:
 
         landmarks = results.multi_face_landmarks[0].landmark
         
-        # Create a black mask
-        mask = np.zeros((height, width), dtype=np.uint8)
+        def to_points(indices):
+            return [[int(landmarks[i].x * width), int(landmarks[i].y * height)] for i in indices]
         
-        # Get coordinates for inner lips
-        points = []
-        for index in self.INNER_LIPS_INDICES:
-            pt = landmarks[index]
-            x = int(pt.x * width)
-            y = int(pt.y * height)
-            points.append([x, y])
-            
-        points = np.array(points, np.int32)
-        points = points.reshape((-1, 1, 2))
+        return {
+            "width": width,
+            "height": height,
+            "inner_lips": to_points(self.INNER_LIPS_INDICES),
+            "outer_lips": to_points(self.OUTER_LIPS_INDICES),
+        }
+
+    @staticmethod
+    def build_mask(landmarks: dict, dilation: int = 40, feather: int = 21,
+                   include_lips: bool = False, include_gums: bool = False) -> np.ndarray:
+        """Rasterize the mouth mask from cached landmarks. Only polygon fill and morphology run here."""
+        width, height = landmarks["width"], landmarks["height"]
+        inner = np.array(landmarks["inner_lips"], np.int32)
+        polygons = [inner]
+        if include_lips:
+            polygons.append(np.array(landmarks["outer_lips"], np.int32))
+        
+        # Gum line sits above the visible teeth; extend upwards by a share of the mouth opening
+        gum_extension = 0
+        if include_gums:
+            gum_extension = max(1, int((inner[:, 1].max() - inner[:, 1].min()) * 0.35))
+        
+        # Work on a padded ROI around the mouth instead of the whole frame
+        all_points = np.concatenate(polygons)
+        pad = dilation + feather + gum_extension + 2
+        x0 = max(int(all_points[:, 0].min()) - pad, 0)
+        y0 = max(int(all_points[:, 1].min()) - pad, 0)
+        x1 = min(int(all_points[:, 0].max()) + pad + 1, width)
+        y1 = min(int(all_points[:, 1].max()) + pad + 1, height)
+        
+        mask = np.zeros((height, width), dtype=np.uint8)
+        if x1 <= x0 or y1 <= y0:
+            return mask
+        roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
         
         # Fill the polygon (mouth area) with white (255)
-        # Fill the polygon (mouth area) with white (255)
-        cv2.fillPoly(mask, [points], 255)
+        cv2.fillPoly(roi, [(p - [x0, y0]).reshape((-1, 1, 2)) for p in polygons], 255)
+        
+        if gum_extension:
+            # Anchor at the top row so the kernel only grows the mask upwards
+            gum_kernel = np.ones((gum_extension + 1, 1), np.uint8)
+            roi = cv2.dilate(roi, gum_kernel, anchor=(0, 0), iterations=1)
         
         # Smart Masking Improvements:
-        # 1. Dilate the mask significantly to include the lips and gum line.
+        # 1. Dilate the mask to include the lips and gum line.
         # This allows the AI to "harmonize" the lips with the new teeth and ensures a seamless blend.
-        kernel = np.ones((40, 40), np.uint8) # Increased from 15 to 40 to cover lips
-        mask = cv2.dilate(mask, kernel, iterations=1)
+        if dilation > 0:
+            kernel = np.ones((dilation, dilation), np.uint8)
+            roi = cv2.dilate(roi, kernel, iterations=1)
+        
+        # 2. Blur the edges for soft transition (Gaussian kernel size must be odd)
+        if feather > 0:
+            feather = feather if feather % 2 == 1 else feather + 1
+            roi = cv2.GaussianBlur(roi, (feather, feather), 0)
         
-        # 2. Blur the edges for soft transition
-        mask = cv2.GaussianBlur(mask, (21, 21), 0)
+        mask[y0:y1, x0:x1] = roi
+        return mask
+
+    @staticmethod
+    def encode_mask(mask: np.ndarray) -> str:
+        # Low PNG compression: masks are mostly flat, and encode time matters for interactive tuning
+        _, buffer = cv2.imencode('.png', mask, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return base64.b64encode(buffer).decode('utf-8')
+
+    @staticmethod
+    def decode_image(image_bytes: bytes) -> np.ndarray:
+        # Convert bytes to numpy array
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        
+        if image is None:
+            raise ValueError("Could not decode image")
+        return image
+
+    def process_image(self, image_bytes: bytes) -> dict:
+        image = self.decode_image(image_bytes)
+
+        height, width, _ = image.shape
+        landmarks = self.detect_landmarks(image)
+        mask = self.build_mask(landmarks, **MASK_PRESETS["default"])
         
         # Encode mask to base64
-        _, buffer = cv2.imencode('.png', mask)
-        mask_base64 = base64.b64encode(buffer).decode('utf-8')
+        mask_base64 = self.encode_mask(mask)
         
         # Encode original image to base64 for convenience
         _, img_buffer = cv2.imencode('.jpg', image)
@@ -77,5 +145,6 @@ class ImageProcessor:
             "mask": mask_base64,
             "image": image_base64,
             "width": width,
-            "height": height
+            "height": height,
+            "landmarks": landmarks
         }
@@ -0,0 +1,52 @@
+import os
+import hmac
+import json
+import time
+import zlib
+import base64
+import hashlib
+from typing import Optional
+
+from auth import SECRET_KEY
+
+LANDMARK_TOKEN_TTL = float(os.getenv("LANDMARK_TOKEN_TTL", "3600"))  # seconds
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class LandmarkTokens:
+    """Signed, self-contained landmark ids so masks can be rebuilt without rerunning FaceMesh.
+
+    The polygons travel inside the id, so /remask works no matter which worker process
+    served /generate-mask, and nothing has to be stored server-side.
+    """
+
+    def __init__(self, secret: str = SECRET_KEY, ttl: float = LANDMARK_TOKEN_TTL):
+        self._key = hashlib.sha256(f"landmarks:{secret}".encode("utf-8")).digest()
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode("ascii"), hashlib.sha256).digest()[:16])
+
+    def put(self, landmarks: dict) -> str:
+        body = dict(landmarks, exp=int(time.time() + self.ttl))
+        payload = _b64encode(zlib.compress(json.dumps(body, separators=(",", ":")).encode("utf-8")))
+        return f"{payload}.{self._sign(payload)}"
+
+    def get(self, landmarks_id: str) -> Optional[dict]:
+        payload, _, signature = landmarks_id.partition(".")
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            landmarks = json.loads(zlib.decompress(_b64decode(payload)))
+        except (ValueError, zlib.error):
+            return None
+        if landmarks.pop("exp", 0) < time.time():
+            return None
+        return landmarks
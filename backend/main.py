@@ -1,18 +1,35 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Request
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, status, Request, Response, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import List, Optional
-import os
+import asyncio
+import hashlib
 import traceback
+import numpy as np
+from PIL import Image
 
 from database import engine, init_db, get_db, User, Generation
 from auth import get_current_user, create_access_token, get_password_hash, verify_password, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user_optional
-from image_processing import ImageProcessor
-from generative_service import GenerativeService
+from image_processing import ImageProcessor, MASK_PRESETS
+from landmark_tokens import LandmarkTokens
+from history_export import export_response
+from idempotency import IdempotencyStore, fingerprint, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_MAX_BYTES
+from scheduler import FairScheduler
+from runtime import (
+    run_cpu, start_cpu_pool, stop_cpu_pool, worker_processes, process_image_job, landmarks_job, remask_job,
+)
+from generative_service import GenerativeService, build_smile_prompt
+from persistence import GenerationWriter, GenerationRecord, resolve_image_url
+from static_assets import StaticIndex
+from admission import (
+    MemoryBudget, BodySizeLimitMiddleware, spool_upload, probe_image, probe_image_bytes, check_image_pixels,
+    decode_base64_image, estimate_decoded_bytes, estimate_held_bytes, estimate_mask_bytes, MEMORY_BUDGET_BYTES,
+    MAX_IMAGE_PIXELS,
+)
 import replicate
 
 # Initialize Database
@@ -31,6 +48,10 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 # ... (CORS setup)
 
+# Reject oversized bodies before they are buffered into memory.
+# Added before CORS so CORS stays outermost and its headers are on the 413 too.
+app.add_middleware(BodySizeLimitMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -40,8 +61,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-processor = ImageProcessor()
-gen_service = GenerativeService()
+# Everything created at import time is safe to share across forked workers (see gunicorn.conf.py).
+# FaceMesh and Vertex AI hold threads / gRPC channels, so they are created per worker on startup.
+gen_service: Optional[GenerativeService] = None
+generation_writer = GenerationWriter()
+landmark_tokens = LandmarkTokens()
+
+# Memory, model concurrency, quotas and replay caps are configured per container.
+# Each worker process holds its own copy, so it enforces a 1/N share.
+workers = worker_processes()
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES // workers)
+idempotency_store = IdempotencyStore(
+    max_entries=max(1, IDEMPOTENCY_MAX_ENTRIES // workers),
+    max_bytes=IDEMPOTENCY_MAX_BYTES // workers,
+)
+model_scheduler = FairScheduler(workers=workers)
+
+if estimate_decoded_bytes(MAX_IMAGE_PIXELS, 1) > memory_budget.total_bytes:
+    print(f"Warning: each of {workers} workers has {memory_budget.total_bytes} bytes of MEMORY_BUDGET_BYTES, "
+          f"less than a {MAX_IMAGE_PIXELS}-pixel image needs; large photos will get 413. "
+          f"Lower WEB_CONCURRENCY or raise MEMORY_BUDGET_BYTES.")
+
+@app.on_event("startup")
+def start_worker_services():
+    global gen_service
+    gen_service = GenerativeService()
+    start_cpu_pool() # FaceMesh lives in the pool processes
+    generation_writer.start()
+
+@app.on_event("shutdown")
+def stop_worker_services():
+    # Flush queued generation records before the process exits
+    generation_writer.stop()
+    stop_cpu_pool()
 
 # --- Pydantic Models ---
 from pydantic import BaseModel, Field
@@ -63,6 +115,14 @@ class GenerateRequest(BaseModel):
     style_prompt: Optional[str] = None # New material selection
     expert_prompt: Optional[str] = None # New expert notes
 
+class RemaskRequest(BaseModel):
+    landmarks_id: str
+    dilation: int = Field(40, ge=0, le=200)
+    feather: int = Field(21, ge=0, le=151)
+    include_lips: bool = False
+    include_gums: bool = False
+    presets: Optional[List[str]] = None # If set, return one mask per named preset instead
+
 class GenerationResponse(BaseModel):
     id: int
     image_url: str
@@ -105,83 +165,284 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 
 @app.post("/generate-mask")
 async def generate_mask(file: UploadFile = File(...)):
+    spool = await spool_upload(file)
     try:
-        contents = await file.read()
-        result = processor.process_image(contents)
+        # Check dimensions from the header, then wait for memory before decoding
+        width, height = probe_image(spool)
+        async with memory_budget.reserve(estimate_decoded_bytes(width, height)):
+            contents = spool.read()
+            result = await run_cpu(process_image_job, contents)
+        # Hand back the landmarks as a signed id so /remask can rebuild the mask without the photo
+        result["landmarks_id"] = landmark_tokens.put(result.pop("landmarks"))
         return result
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        spool.close()
 
-@app.post("/generate-smile")
-async def generate_smile(
-    request: GenerateRequest, 
-    current_user: Optional[User] = Depends(get_current_user_optional), # Optional auth for now, or enforce it
-    db: Session = Depends(get_db)
-):
+@app.post("/remask")
+async def remask(request: RemaskRequest):
+    landmarks = landmark_tokens.get(request.landmarks_id)
+    if landmarks is None:
+        raise HTTPException(status_code=404, detail="Landmarks expired or not found, upload the photo again")
+    # Masks are allocated at the token's size, so it gets the same limits as an upload
+    width, height = int(landmarks["width"]), int(landmarks["height"])
+    check_image_pixels(width, height)
+
+    if request.presets:
+        unknown = [name for name in request.presets if name not in MASK_PRESETS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown presets: {', '.join(unknown)}")
+        params_by_name = {name: MASK_PRESETS[name] for name in request.presets}
+    else:
+        params_by_name = {"mask": {
+            "dilation": request.dilation,
+            "feather": request.feather,
+            "include_lips": request.include_lips,
+            "include_gums": request.include_gums,
+        }}
+
+    # Masks are built one at a time in the pool
+    async with memory_budget.reserve(estimate_mask_bytes(width, height)):
+        masks = await run_cpu(remask_job, landmarks, params_by_name)
+
+    if request.presets:
+        return {"masks": masks, "width": width, "height": height}
+    return {"mask": masks["mask"], "width": width, "height": height}
+
+def _principal(current_user: Optional[User], http_request: Request) -> str:
+    """Who a request is accounted to: the user if logged in, otherwise the client IP."""
+    if current_user:
+        return f"user:{current_user.id}"
+    return f"ip:{http_request.client.host if http_request.client else 'unknown'}"
+
+async def _run_generation(request: GenerateRequest, user_id: Optional[int], principal: str) -> dict:
     try:
         # Remove header if present
         image_data = request.image.split(",")[1] if "," in request.image else request.image
+
+        # Enforce byte and pixel limits from the image header before any pixels are decoded
+        width, height = probe_image_bytes(decode_base64_image(image_data))
         
-        mask_data = request.mask.split(",")[1] if "," in request.mask else request.mask
+        mask_data = None # No mask -> mask-free editing
+        working_bytes = estimate_decoded_bytes(width, height) - estimate_held_bytes(width, height)
+        if request.mask:
+            mask_data = request.mask.split(",")[1] if "," in request.mask else request.mask
+            # The mask is decoded and resized too, so it gets the same checks and counts toward memory
+            working_bytes += estimate_mask_bytes(*probe_image_bytes(decode_base64_image(mask_data)))
         
-        full_prompt = f"""
-Act as an expert dental aesthetician and professional photographer.
-Task: Redesign the smile with high-quality porcelain laminate veneers.
-1. Camera & Lighting: Macro dental photography, 100mm macro lens, soft studio lighting, 8k resolution, hyperrealistic texture.
-2. Teeth Design: Apply {request.style_prompt if request.style_prompt else "natural ivory white veneers with translucent enamel texture"}. Ensure realistic light reflections, slight surface texture (perikymata), and natural optical properties.
-3. Lip Harmonization: You MUST adjust the lip structure to fit the new teeth perfectly. Subtly lift the upper lip or reshape the lower lip to create a natural smile line. The teeth must sit naturally behind the lips, not on top of them.
-4. Integration: The result must be indistinguishable from a real photo. Blend the new smile seamlessly with the facial expression and beard.
-5. Details: {request.expert_prompt if request.expert_prompt else "Perfect anatomical fit, golden ratio proportions, healthy pink gingiva."}
-"""
-        # If legacy prompt is provided and no new fields, fallback to it (or append it)
-        if request.prompt and not request.style_prompt:
-             full_prompt += f"\n[ADDITIONAL]: {request.prompt}"
+        full_prompt = build_smile_prompt(request.style_prompt, request.expert_prompt, request.prompt)
 
         # print("Sending Prompt to Vertex AI:\n", full_prompt)
 
-        result_url = gen_service.generate_smile(image_data, mask_data, full_prompt)
+        # Same stages as /design (see _run_design)
+        memory_budget.check(estimate_held_bytes(width, height) + working_bytes)
+        async with model_scheduler.admit(principal, anonymous=user_id is None) as ticket:
+            async with memory_budget.reserve(estimate_held_bytes(width, height)):
+                async with memory_budget.reserve(working_bytes):
+                    inputs = await run_in_threadpool(gen_service.decode_inputs, image_data, mask_data)
+                async with model_scheduler.turn(ticket):
+                    async with memory_budget.reserve(working_bytes):
+                        result_url = await run_in_threadpool(gen_service.run_edit, inputs, full_prompt)
         
-        # Save to history if user is logged in
-        if current_user:
-            new_gen = Generation(
-                user_id=current_user.id,
-                original_image_url="[Base64 Data]", # Placeholder
+        # Save to history if user is logged in (write-behind, see persistence.py)
+        if user_id:
+            await run_in_threadpool(generation_writer.submit, GenerationRecord(
+                user_id=user_id,
                 generated_image_url=result_url, # This is now a base64 string from Vertex AI
                 prompt=request.style_prompt or request.prompt or "Custom Design"
-            )
-            db.add(new_gen)
-            db.commit()
+            ))
             
         return {"image_url": result_url}
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error: {str(e)}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate-smile")
+async def generate_smile(
+    request: GenerateRequest, 
+    http_request: Request,
+    response: Response,
+    current_user: Optional[User] = Depends(get_current_user_optional), # Optional auth for now, or enforce it
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    user_id = current_user.id if current_user else None
+    principal = _principal(current_user, http_request)
+    if not idempotency_key:
+        return await _run_generation(request, user_id, principal)
+
+    # Retries with the same key attach to the running call or replay its stored result
+    scope_key = f"{principal}:{idempotency_key}"
+    result, replayed = await idempotency_store.run(
+        scope_key,
+        await run_in_threadpool(_generate_fingerprint, request),
+        lambda: _run_generation(request, user_id, principal),
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+async def _run_design(spool, width: int, height: int, style_prompt: Optional[str], expert_prompt: Optional[str],
+                      prompt: Optional[str], return_mask: bool, user_id: Optional[int], principal: str) -> dict:
+    # Owns the spooled upload: an idempotent retry may keep this running after the first request is gone
+    #
+    # Stages: quota first (429 before any work), then memory for decoding and masking, then the
+    # fair-queue turn only around the model call. While waiting for the turn a request keeps just
+    # the held share of its memory (original + mask); the working share is taken per stage.
+    held_bytes = estimate_held_bytes(width, height)
+    working_bytes = estimate_decoded_bytes(width, height) - held_bytes
+    try:
+        memory_budget.check(held_bytes + working_bytes)
+        async with model_scheduler.admit(principal, anonymous=user_id is None) as ticket:
+            async with memory_budget.reserve(held_bytes):
+                async with memory_budget.reserve(working_bytes):
+                    # 1. Decode once. FaceMesh runs in the CPU pool on the model-sized copy,
+                    # which is also what Vertex AI receives.
+                    try:
+                        original_image, model_image = await run_in_threadpool(gen_service.load_image, spool)
+                        landmarks = await run_cpu(landmarks_job, np.asarray(model_image), *original_image.size)
+                    except (ValueError, OSError) as e:
+                        # Undecodable photo or no face: the client's input, not ours (quota is refunded)
+                        raise HTTPException(status_code=400, detail=str(e))
+
+                    # 2. Full-res mask straight from the landmarks, no base64 round trip
+                    mask = await run_in_threadpool(ImageProcessor.build_mask, landmarks)
+                    mask_image = Image.fromarray(mask)
+
+                    # 3. Encode model inputs while the prompt is assembled
+                    inputs_task = asyncio.ensure_future(run_in_threadpool(
+                        gen_service.prepare_inputs, original_image, mask_image, model_image
+                    ))
+                    full_prompt = build_smile_prompt(style_prompt, expert_prompt, prompt)
+                    inputs = await inputs_task
+                    model_image = None  # Only its encoded copy in `inputs` is needed from here
+
+                # 4. Model call and full-res compositing
+                async with model_scheduler.turn(ticket):
+                    async with memory_budget.reserve(working_bytes):
+                        result_url = await run_in_threadpool(gen_service.run_edit, inputs, full_prompt)
+
+                response = {
+                    "image_url": result_url,
+                    "landmarks_id": landmark_tokens.put(landmarks),
+                    "width": original_image.width,
+                    "height": original_image.height,
+                }
+                if return_mask:
+                    response["mask"] = await run_in_threadpool(ImageProcessor.encode_mask, mask)
+
+        # Save to history if user is logged in (write-behind, see persistence.py)
+        if user_id:
+            await run_in_threadpool(generation_writer.submit, GenerationRecord(
+                user_id=user_id,
+                generated_image_url=result_url,
+                prompt=style_prompt or prompt or "Custom Design"
+            ))
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        spool.close()
+
+@app.post("/design")
+async def design(
+    http_request: Request,
+    response: Response,
+    file: UploadFile = File(...),
+    style_prompt: Optional[str] = Form(None),
+    expert_prompt: Optional[str] = Form(None),
+    prompt: Optional[str] = Form(None),
+    return_mask: bool = Form(False),
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """One-shot mask + generation from a multipart upload (replaces /generate-mask + /generate-smile)."""
+    user_id = current_user.id if current_user else None
+    principal = _principal(current_user, http_request)
+    spool = await spool_upload(file)
+    started = False
+
+    def run():
+        nonlocal started
+        started = True
+        return _run_design(spool, width, height, style_prompt, expert_prompt, prompt, return_mask, user_id, principal)
+
+    try:
+        width, height = probe_image(spool)
+        if not idempotency_key:
+            return await run()
+
+        request_fingerprint = fingerprint({
+            "image_sha256": await run_in_threadpool(_file_sha256, spool),
+            "style_prompt": style_prompt,
+            "expert_prompt": expert_prompt,
+            "prompt": prompt,
+            "return_mask": return_mask,
+        })
+        result, replayed = await idempotency_store.run(f"{principal}:{idempotency_key}", request_fingerprint, run)
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+    finally:
+        if not started:
+            spool.close()
+
+def _generate_fingerprint(request: GenerateRequest) -> str:
+    # Digests of the base64 payloads, so multi-MB images aren't re-serialised into the fingerprint
+    return fingerprint({
+        "image_sha256": hashlib.sha256(request.image.encode("utf-8")).hexdigest(),
+        "mask_sha256": hashlib.sha256(request.mask.encode("utf-8")).hexdigest() if request.mask else None,
+        "prompt": request.prompt,
+        "style_prompt": request.style_prompt,
+        "expert_prompt": request.expert_prompt,
+    })
+
+def _file_sha256(fileobj) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
 @app.get("/history", response_model=List[GenerationResponse])
 async def get_history(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     generations = db.query(Generation).filter(Generation.user_id == current_user.id).order_by(Generation.created_at.desc()).all()
     return [
         {
             "id": gen.id,
-            "image_url": gen.generated_image_url,
+            "image_url": resolve_image_url(gen.generated_image_url),
             "created_at": gen.created_at.isoformat()
         } 
         for gen in generations
     ]
 
+@app.get("/history/export")
+async def export_history(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Streams a ZIP of all generations plus metadata; supports Range / If-Range for resumed downloads
+    return await export_response(request, current_user.id, db)
+
 # --- Static Files ---
 
-if os.path.exists("static"):
-    app.mount("/_next", StaticFiles(directory="static/_next"), name="next")
+# Exported frontend is indexed once at startup (see static_assets.py)
+static_index = StaticIndex("static")
 
 @app.get("/")
-async def read_index():
-    if os.path.exists("static/index.html"):
-        return FileResponse("static/index.html")
+async def read_index(request: Request):
+    if static_index.fallback:
+        return static_index.serve(static_index.fallback, request)
     return {"message": "Smile Design AI API is running (Frontend not found)"}
 
 @app.get("/health")
@@ -190,25 +451,12 @@ async def health_check():
 
 # Catch-all for SPA / Static Pages
 @app.get("/{full_path:path}")
-async def catch_all(full_path: str):
-    # 1. Check for exact file match (e.g. favicon.ico, robots.txt)
-    file_path = os.path.join("static", full_path)
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return FileResponse(file_path)
-    
-    # 2. Check for .html file (e.g. /login -> static/login.html)
-    html_path = os.path.join("static", f"{full_path}.html")
-    if os.path.exists(html_path):
-        return FileResponse(html_path)
-        
-    # 3. Check for index.html in directory (e.g. /blog -> static/blog/index.html)
-    index_path = os.path.join("static", full_path, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
-
-    # 4. Fallback to index.html (for client-side routing of dynamic paths)
-    if os.path.exists("static/index.html"):
-        return FileResponse("static/index.html")
-        
-    return {"message": "Frontend not found"}
+async def catch_all(full_path: str, request: Request):
+    # Exact file, then .html, then dir/index.html, then index.html for client-side routing
+    asset = static_index.lookup(full_path)
+    if asset:
+        return static_index.serve(asset, request)
+    if static_index:
+        raise HTTPException(status_code=404, detail="Not Found")
 
+    return {"message": "Frontend not found"}
@@ -0,0 +1,278 @@
+import os
+import queue
+import threading
+import time
+import uuid
+import base64
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy.exc import IntegrityError, DataError
+
+from database import SessionLocal, Generation
+
+# Durability modes:
+#   "sync"        -> write inline before the response is returned (old behaviour, fsyncs blobs)
+#   "batched"     -> queue and flush in batches; a full queue blocks the caller and failed writes
+#                    are retried until the database is back. Only rows the database rejects are dropped.
+#   "best_effort" -> queue and flush in batches; a full queue drops the record, and a batch is
+#                    dropped after GENERATION_MAX_RETRIES failed attempts
+GENERATION_DURABILITY = os.getenv("GENERATION_DURABILITY", "batched")
+# Records carry full-resolution data URLs, so the queue is bounded by bytes, not by count
+GENERATION_QUEUE_BYTES = int(os.getenv("GENERATION_QUEUE_BYTES", str(256 * 1024 * 1024)))
+GENERATION_BATCH_SIZE = int(os.getenv("GENERATION_BATCH_SIZE", "32"))
+GENERATION_FLUSH_INTERVAL = float(os.getenv("GENERATION_FLUSH_INTERVAL", "0.5"))  # seconds
+GENERATION_MAX_RETRIES = int(os.getenv("GENERATION_MAX_RETRIES", "3"))  # best_effort only
+GENERATION_MAX_BACKOFF = float(os.getenv("GENERATION_MAX_BACKOFF", "30"))  # seconds between retries
+
+# Errors caused by the row itself (e.g. a deleted user); retrying won't help
+_ROW_ERRORS = (IntegrityError, DataError)
+
+# When set, generated images are written as files here and the DB only stores a blob:// reference.
+# When empty, the data URL is stored inline in the DB as before.
+BLOB_STORAGE_DIR = os.getenv("BLOB_STORAGE_DIR", "")
+BLOB_PREFIX = "blob://"
+
+
+# --- Blob Storage ---
+
+def write_blob(data_url: str, fsync: bool = False) -> str:
+    """Store a data URL as a file and return its blob:// reference."""
+    if not BLOB_STORAGE_DIR or not data_url.startswith("data:"):
+        return data_url
+
+    header, payload = data_url.split(",", 1)
+    ext = "png" if "image/png" in header else "jpg"
+    name = f"{uuid.uuid4().hex}.{ext}"
+
+    os.makedirs(BLOB_STORAGE_DIR, exist_ok=True)
+    final_path = os.path.join(BLOB_STORAGE_DIR, name)
+    tmp_path = final_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(base64.b64decode(payload))
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    # Atomic rename so readers never see a half-written blob
+    os.replace(tmp_path, final_path)
+    return f"{BLOB_PREFIX}{name}"
+
+
+def _blob_path(ref: str) -> str:
+    name = os.path.basename(ref[len(BLOB_PREFIX):])
+    return os.path.join(BLOB_STORAGE_DIR, name)
+
+
+def read_blob_bytes(ref: str) -> bytes:
+    """Return the raw image bytes behind a stored image URL (blob:// or data URL)."""
+    if ref.startswith(BLOB_PREFIX):
+        with open(_blob_path(ref), "rb") as f:
+            return f.read()
+    if ref.startswith("data:"):
+        return base64.b64decode(ref.split(",", 1)[1])
+    raise ValueError("Unsupported image reference")
+
+
+def image_available(ref: str) -> bool:
+    """Whether read_blob_bytes can return image bytes for a stored image URL."""
+    if ref.startswith(BLOB_PREFIX):
+        return os.path.isfile(_blob_path(ref))
+    return ref.startswith("data:")
+
+
+def _remove_blob(ref: str):
+    """Delete the file behind a blob:// reference whose row was never committed."""
+    if not ref.startswith(BLOB_PREFIX):
+        return
+    try:
+        os.remove(_blob_path(ref))
+    except FileNotFoundError:
+        pass
+
+
+def resolve_image_url(ref: str) -> str:
+    """Turn a stored image URL back into something the frontend can display."""
+    if not ref or not ref.startswith(BLOB_PREFIX):
+        return ref
+    mime = "image/png" if ref.endswith(".png") else "image/jpeg"
+    payload = base64.b64encode(read_blob_bytes(ref)).decode("utf-8")
+    return f"data:{mime};base64,{payload}"
+
+
+# --- Write-Behind Queue ---
+
+def _record_size(record: "GenerationRecord") -> int:
+    # Dominated by the image; taken before the blob write replaces it with a short reference
+    return len(record.generated_image_url) + len(record.prompt or "")
+
+
+@dataclass
+class GenerationRecord:
+    user_id: int
+    generated_image_url: str
+    prompt: str
+    original_image_url: str = "[Base64 Data]"  # Placeholder
+    created_at: datetime = field(default_factory=datetime.utcnow)
+
+
+class GenerationWriter:
+    """Background writer that persists generation records in batched transactions."""
+
+    def __init__(self, durability: str = GENERATION_DURABILITY, queue_bytes: int = GENERATION_QUEUE_BYTES,
+                 batch_size: int = GENERATION_BATCH_SIZE, flush_interval: float = GENERATION_FLUSH_INTERVAL):
+        if durability not in ("sync", "batched", "best_effort"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self.queue_bytes = queue_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Optional[GenerationRecord]]" = queue.Queue()
+        self._queued_bytes = 0
+        self._space = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def start(self):
+        if self.durability == "sync" or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="generation-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush everything still queued, then stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)  # Sentinel, after everything already queued
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, record: GenerationRecord):
+        """Persist or enqueue a record. May block on disk, DB or backpressure; call it via run_in_threadpool."""
+        if self.durability == "sync" or self._thread is None:
+            self._write_one(record, fsync=True)
+            return
+
+        size = _record_size(record)
+        with self._space:
+            # A record larger than the whole queue is still admitted once the queue is empty
+            while self._queued_bytes and self._queued_bytes + size > self.queue_bytes:
+                if self.durability == "best_effort":
+                    self.dropped += 1
+                    print(f"Generation queue full, dropped record for user {record.user_id}.")
+                    return
+                # Backpressure: wait for the writer to catch up instead of losing the record
+                self._space.wait()
+            self._queued_bytes += size
+        self._queue.put(record)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch: List[GenerationRecord] = []
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+
+            # Gather more records until the batch is full or the flush interval passes
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+
+            # On shutdown drain whatever is left without waiting
+            while stopping:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+
+            sizes = sum(_record_size(record) for record in batch)
+            try:
+                if batch:
+                    self._write_with_retry(batch)
+            finally:
+                with self._space:
+                    self._queued_bytes -= sizes
+                    self._space.notify_all()
+
+    def _write_with_retry(self, batch: List[GenerationRecord]):
+        try:
+            self._retry(batch)
+        except _ROW_ERRORS:
+            # One bad row fails the whole transaction; write the rest one by one
+            for record in batch:
+                try:
+                    self._retry([record])
+                except _ROW_ERRORS as e:
+                    self._discard([record], e)
+
+    def _retry(self, batch: List[GenerationRecord]):
+        """Write a batch, retrying transient failures. Row errors are raised immediately."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._write_batch(batch)
+                return
+            except _ROW_ERRORS:
+                raise
+            except Exception as e:
+                if self.durability == "best_effort" and attempt >= GENERATION_MAX_RETRIES:
+                    self._discard(batch, e)
+                    return
+                delay = min(0.1 * 2 ** attempt, GENERATION_MAX_BACKOFF)
+                print(f"Generation write failed (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def _discard(self, records: List[GenerationRecord], error: Exception):
+        for record in records:
+            # The row never made it, so neither should its image
+            _remove_blob(record.generated_image_url)
+        self.dropped += len(records)
+        print(f"Dropped {len(records)} generation record(s): {error}")
+
+    def _write_one(self, record: GenerationRecord, fsync: bool = False):
+        try:
+            self._write_batch([record], fsync=fsync)
+        except Exception:
+            _remove_blob(record.generated_image_url)
+            raise
+
+    def _write_batch(self, batch: List[GenerationRecord], fsync: bool = False):
+        # Blob writes happen before the transaction so a committed row never points at a missing file.
+        # The reference is kept on the record so a retried batch does not write the blob twice.
+        for record in batch:
+            record.generated_image_url = write_blob(record.generated_image_url, fsync=fsync)
+        rows = [
+            Generation(
+                user_id=record.user_id,
+                original_image_url=record.original_image_url,
+                generated_image_url=record.generated_image_url,
+                prompt=record.prompt,
+                created_at=record.created_at,
+            )
+            for record in batch
+        ]
+        db = SessionLocal()
+        try:
+            db.add_all(rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
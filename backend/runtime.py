@@ -0,0 +1,125 @@
+import os
+import math
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+
+def available_cpus() -> int:
+    """CPUs this container may actually use: cgroup quota, then affinity, then cpu_count."""
+    cpus = os.cpu_count() or 1
+    try:
+        cpus = min(cpus, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        pass
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+
+def web_concurrency() -> int:
+    """Number of web worker processes to start (WEB_CONCURRENCY overrides).
+
+    Defaults to the CPU count, capped so that each worker's share of the memory budget still
+    admits a MAX_IMAGE_PIXELS photo and gets at least one model slot. Image work runs in the
+    per-worker CPU pools, which grow to fill the remaining CPUs.
+    """
+    explicit = int(os.getenv("WEB_CONCURRENCY") or 0)
+    if explicit:
+        return explicit
+
+    from admission import MEMORY_BUDGET_BYTES, MAX_IMAGE_PIXELS, estimate_decoded_bytes
+    from scheduler import MODEL_CONCURRENCY
+    by_memory = MEMORY_BUDGET_BYTES // estimate_decoded_bytes(MAX_IMAGE_PIXELS, 1)
+    return max(1, min(available_cpus(), by_memory, MODEL_CONCURRENCY))
+
+
+def worker_processes() -> int:
+    """Web worker processes sharing this container's limits.
+
+    gunicorn.conf.py exports WEB_CONCURRENCY before the app is loaded; a plain
+    `uvicorn main:app` without it is a single process.
+    """
+    return max(1, int(os.getenv("WEB_CONCURRENCY") or 1))
+
+
+def cpu_pool_size() -> int:
+    """Image-processing processes per web worker, so all workers together fill the CPU quota."""
+    return int(os.getenv("CPU_POOL_SIZE") or 0) or max(1, available_cpus() // worker_processes())
+
+
+# --- CPU Pool ---
+# FaceMesh and mask morphology run here, off the event loop and outside the GIL.
+# Each web worker owns its pool; it is created after fork, never in the preloading master.
+
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_processor = None  # Per pool process
+
+
+def _init_cpu_worker():
+    global _processor
+    from image_processing import ImageProcessor
+    _processor = ImageProcessor()
+
+
+def process_image_job(image_bytes: bytes) -> dict:
+    return _processor.process_image(image_bytes)
+
+
+def landmarks_job(rgb_image, width: int, height: int) -> dict:
+    """Landmarks for a (downscaled) RGB frame, in full-resolution pixel coordinates."""
+    return _processor.detect_landmarks(rgb_image, rgb=True, size=(width, height))
+
+
+def remask_job(landmarks: dict, params_by_name: dict) -> dict:
+    """Build and encode one mask per named parameter set."""
+    from image_processing import ImageProcessor
+    return {
+        name: ImageProcessor.encode_mask(ImageProcessor.build_mask(landmarks, **params))
+        for name, params in params_by_name.items()
+    }
+
+
+def start_cpu_pool():
+    global _cpu_pool
+    if _cpu_pool is None:
+        # spawn: never fork a process that already runs threads (gRPC, writer thread, FaceMesh)
+        _cpu_pool = ProcessPoolExecutor(
+            max_workers=cpu_pool_size(),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_cpu_worker,
+        )
+        print(f"CPU pool started with {cpu_pool_size()} processes.")
+
+
+def stop_cpu_pool():
+    global _cpu_pool
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=True, cancel_futures=True)
+        _cpu_pool = None
+
+
+async def run_cpu(fn, *args):
+    start_cpu_pool()
+    return await asyncio.get_running_loop().run_in_executor(_cpu_pool, fn, *args)
@@ -0,0 +1,192 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from fastapi import HTTPException
+
+# Limits below are per container; FairScheduler(workers=N) gives each web worker its 1/N share
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "4"))  # Concurrent model calls
+
+# Token buckets: sustained rate per minute and burst size
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))
+USER_BURST = float(os.getenv("USER_BURST", "10"))
+ANON_RATE_PER_MINUTE = float(os.getenv("ANON_RATE_PER_MINUTE", "2"))
+ANON_BURST = float(os.getenv("ANON_BURST", "3"))
+
+# Share of model capacity under contention (weighted fair queuing)
+USER_WEIGHT = float(os.getenv("USER_WEIGHT", "1.0"))
+ANON_WEIGHT = float(os.getenv("ANON_WEIGHT", "0.25"))
+
+# Requests one principal may have waiting or running at once
+MAX_PENDING_PER_PRINCIPAL = int(os.getenv("MAX_PENDING_PER_PRINCIPAL", "4"))
+
+_MAX_TRACKED_PRINCIPALS = 10000
+
+
+def _too_many(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Take one token. Returns 0 on success, otherwise seconds until a token is available."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 3600.0
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Ticket:
+    __slots__ = ("principal", "weight", "bucket", "started")
+
+    def __init__(self, principal: str, weight: float, bucket: TokenBucket):
+        self.principal = principal
+        self.weight = weight
+        self.bucket = bucket
+        self.started = False
+
+
+class FairScheduler:
+    """Admits model calls per principal with token-bucket quotas and weighted fair queuing.
+
+    Principals are "user:<id>" or "ip:<addr>". Each call is one unit of work; a principal's
+    virtual finish time advances by 1/weight per call, and free slots go to the lowest
+    finish time, so a user with a deep backlog can't starve others.
+
+    Callers `admit()` first, which applies the quota before any work is done, then hold
+    `turn()` only around the model call. A request that never reaches its turn (bad photo,
+    no memory) gets its token back.
+
+    State lives in this process. With `workers` > 1 the concurrency and token rates are
+    divided between workers; ordering is only fair within a worker, and each bucket keeps
+    at least one token of burst, so a principal can burst up to `workers` calls.
+    """
+
+    def __init__(self, concurrency: int = MODEL_CONCURRENCY, workers: int = 1):
+        if workers > concurrency:
+            print(f"Warning: {workers} workers share MODEL_CONCURRENCY={concurrency}; each worker still "
+                  f"runs one call at a time, so up to {workers} model calls may run at once.")
+        self.concurrency = max(1, concurrency // workers)
+        self.workers = workers
+        self.active = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._pending: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._avg_service_time = 10.0  # seconds, updated as calls complete
+
+    def _bucket(self, principal: str, anonymous: bool) -> TokenBucket:
+        bucket = self._buckets.get(principal)
+        if bucket is None:
+            if len(self._buckets) > _MAX_TRACKED_PRINCIPALS:
+                # Full buckets carry no state worth keeping
+                for key in [k for k, b in self._buckets.items() if b.is_full()]:
+                    del self._buckets[key]
+            rate, burst = (ANON_RATE_PER_MINUTE, ANON_BURST) if anonymous else (USER_RATE_PER_MINUTE, USER_BURST)
+            bucket = TokenBucket(rate / self.workers, max(1.0, burst / self.workers))
+            self._buckets[principal] = bucket
+        return bucket
+
+    def _tags(self, principal: str, weight: float):
+        start = max(self._virtual_time, self._last_finish.get(principal, 0.0))
+        finish = start + 1.0 / weight
+        self._last_finish[principal] = finish
+        return start, finish
+
+    @asynccontextmanager
+    async def admit(self, principal: str, anonymous: bool = False):
+        """Apply quota and pending limits (429) and yield a ticket for turn()."""
+        pending = self._pending.get(principal, 0)
+        if pending >= MAX_PENDING_PER_PRINCIPAL:
+            wait = self._avg_service_time * pending / max(self.concurrency, 1)
+            raise _too_many("Too many design requests in progress, please wait", wait)
+
+        bucket = self._bucket(principal, anonymous)
+        retry_after = bucket.take()
+        if retry_after:
+            raise _too_many("Design quota exceeded, please retry later", retry_after)
+
+        ticket = _Ticket(principal, ANON_WEIGHT if anonymous else USER_WEIGHT, bucket)
+        self._pending[principal] = pending + 1
+        try:
+            yield ticket
+        finally:
+            if not ticket.started:
+                bucket.refund()  # Failed before the model call; don't charge for it
+            self._pending[principal] -= 1
+            if not self._pending[principal]:
+                del self._pending[principal]
+
+    @asynccontextmanager
+    async def turn(self, ticket: _Ticket):
+        """Wait for a fair share of a model slot and hold it."""
+        await self._acquire(ticket.principal, ticket.weight)
+        ticket.started = True
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed
+            self._release()
+
+    async def _acquire(self, principal: str, weight: float):
+        start, finish = self._tags(principal, weight)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._seq), start, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was handed over just as we were cancelled; pass it on
+                self._release()
+            else:
+                future.cancel()  # Skipped lazily when popped
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._heap and self.active < self.concurrency:
+            _, _, start, future = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue
+            self._virtual_time = max(self._virtual_time, start)
+            self.active += 1
+            future.set_result(None)
+
+        if len(self._last_finish) > _MAX_TRACKED_PRINCIPALS:
+            # Principals behind virtual time would restart from it anyway
+            self._last_finish = {k: v for k, v in self._last_finish.items() if v > self._virtual_time}
@@ -0,0 +1,178 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response, FileResponse
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
+
+# Files larger than this are served from disk instead of being kept in memory
+STATIC_MAX_INMEMORY_BYTES = int(os.getenv("STATIC_MAX_INMEMORY_BYTES", str(8 * 1024 * 1024)))
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/javascript", "application/json", "application/xml",
+    "image/svg+xml", "application/manifest+json", "font/ttf", "font/otf",
+)
+
+# Next.js puts content-hashed build output here, so it can be cached forever
+IMMUTABLE_PREFIX = "_next/static/"
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+HTML_CACHE = "no-cache"
+DEFAULT_CACHE = "public, max-age=3600"
+
+
+@dataclass
+class StaticAsset:
+    path: str
+    content_type: str
+    etag: str
+    cache_control: str
+    body: Optional[bytes] = None  # None -> served from disk
+    encodings: Dict[str, bytes] = field(default_factory=dict)  # "br" / "gzip" -> compressed body
+
+    def etag_for(self, encoding: Optional[str]) -> str:
+        # Each representation needs its own strong ETag
+        if not encoding:
+            return self.etag
+        return f'{self.etag[:-1]}-{encoding}"'
+
+
+def _is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def _parse_accept_encoding(header: str) -> Dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+class StaticIndex:
+    """In-memory route table for the exported frontend, built once at startup."""
+
+    def __init__(self, root: str = "static"):
+        self.root = root
+        self.routes: Dict[str, StaticAsset] = {}
+        self.fallback: Optional[StaticAsset] = None
+        if os.path.isdir(root):
+            self._scan()
+
+    def __bool__(self):
+        return bool(self.routes)
+
+    def _scan(self):
+        assets: Dict[str, StaticAsset] = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+                assets[rel_path] = self._load(full_path, rel_path)
+
+        # Same resolution order as the old catch-all: exact file, then .html, then dir/index.html
+        for rel_path, asset in assets.items():
+            if rel_path.endswith("/index.html"):
+                self.routes.setdefault(rel_path[:-len("/index.html")], asset)
+        for rel_path, asset in assets.items():
+            if rel_path.endswith(".html"):
+                self.routes[rel_path[:-len(".html")]] = asset
+        self.routes.update(assets)
+
+        self.fallback = assets.get("index.html")
+        if self.fallback:
+            self.routes[""] = self.fallback
+        print(f"Indexed {len(assets)} static files ({len(self.routes)} routes).")
+
+    def _load(self, full_path: str, rel_path: str) -> StaticAsset:
+        content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        if rel_path.startswith(IMMUTABLE_PREFIX):
+            cache_control = IMMUTABLE_CACHE
+        elif content_type == "text/html":
+            cache_control = HTML_CACHE
+        else:
+            cache_control = DEFAULT_CACHE
+
+        digest = hashlib.sha256()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        asset = StaticAsset(
+            path=full_path,
+            content_type=content_type,
+            etag=f'"{digest.hexdigest()[:32]}"',
+            cache_control=cache_control,
+        )
+
+        if os.path.getsize(full_path) > STATIC_MAX_INMEMORY_BYTES:
+            return asset
+
+        with open(full_path, "rb") as f:
+            asset.body = f.read()
+
+        # Precompress once; only keep variants that are actually smaller
+        if _is_compressible(content_type) and len(asset.body) > 256:
+            gz = gzip.compress(asset.body, compresslevel=9, mtime=0)
+            if len(gz) < len(asset.body):
+                asset.encodings["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(asset.body, quality=11)
+                if len(br) < len(asset.body):
+                    asset.encodings["br"] = br
+        return asset
+
+    def lookup(self, path: str) -> Optional[StaticAsset]:
+        path = path.strip("/")
+        asset = self.routes.get(path)
+        if asset is not None:
+            return asset
+        # Missing build assets are real 404s, not SPA routes
+        if path.startswith("_next/"):
+            return None
+        return self.fallback
+
+    def serve(self, asset: StaticAsset, request: Request) -> Response:
+        encoding = None
+        if asset.encodings:
+            accepted = _parse_accept_encoding(request.headers.get("accept-encoding", ""))
+            for candidate in ("br", "gzip"):
+                if candidate in asset.encodings and accepted.get(candidate, 0) > 0:
+                    encoding = candidate
+                    break
+
+        etag = asset.etag_for(encoding)
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if asset.encodings:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            known = {asset.etag} | {asset.etag_for(e) for e in asset.encodings}
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & known:
+                return Response(status_code=304, headers=headers)
+
+        if asset.body is None:
+            return FileResponse(asset.path, media_type=asset.content_type, headers=headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(asset.encodings[encoding], media_type=asset.content_type, headers=headers)
+        return Response(asset.body, media_type=asset.content_type, headers=headers)
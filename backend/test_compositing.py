@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from compositing import composite_roi, mask_bbox
+
+
+def _random_image(width, height, seed):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def _soft_mask(width, height):
+    # Feathered ellipse: fully opaque core, partial alpha at the edge, zero outside
+    y, x = np.ogrid[:height, :width]
+    distance = ((x - width * 0.5) / (width * 0.2)) ** 2 + ((y - height * 0.6) / (height * 0.1)) ** 2
+    alpha = np.clip((1.5 - distance) * 255, 0, 255).astype(np.uint8)
+    return Image.fromarray(alpha, mode="L")
+
+
+def _max_diff(a, b):
+    return int(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max())
+
+
+def test_matches_image_composite():
+    original = _random_image(320, 240, seed=1)
+    generated = _random_image(320, 240, seed=2)
+    mask = _soft_mask(320, 240)
+
+    expected = Image.composite(generated, original, mask)
+    assert _max_diff(composite_roi(original, generated, mask), expected) <= 1
+
+
+def test_matches_upscaled_composite():
+    # Model output at a lower resolution than the original photo
+    original = _random_image(640, 480, seed=3)
+    generated = _random_image(320, 240, seed=4)
+    mask = _soft_mask(640, 480)
+
+    expected = Image.composite(generated.resize(original.size, Image.LANCZOS), original, mask)
+    result = np.asarray(composite_roi(original, generated, mask))
+    # Outside the mask the original is untouched
+    outside = np.asarray(mask) == 0
+    assert (result[outside] == np.asarray(original)[outside]).all()
+    # Resampling only the ROI with a float source box lines up with resizing the whole frame
+    assert _max_diff(result, expected) <= 1
+
+
+def test_empty_mask():
+    original = _random_image(64, 48, seed=5)
+    mask = Image.new("L", original.size, 0)
+    assert mask_bbox(np.asarray(mask)) is None
+    assert _max_diff(composite_roi(original, _random_image(64, 48, seed=6), mask), original) == 0
+
+
+if __name__ == "__main__":
+    test_matches_image_composite()
+    test_matches_upscaled_composite()
+    test_empty_mask()
+    print("SUCCESS: compositing tests passed.")
@@ -0,0 +1,65 @@
+import os
+import sys
+
+from fastapi import HTTPException
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from history_export import _parse_range, _slice
+
+
+def _not_satisfiable(header, length):
+    try:
+        _parse_range(header, length)
+    except HTTPException as e:
+        assert e.status_code == 416
+        assert e.headers["Content-Range"] == f"bytes */{length}"
+    else:
+        raise AssertionError(f"expected 416 for {header!r}")
+
+
+def test_parse_range():
+    assert _parse_range("bytes=0-99", 1000) == (0, 99)
+    assert _parse_range("bytes=500-", 1000) == (500, 999)
+    assert _parse_range("bytes=900-5000", 1000) == (900, 999)  # End clamped to the file
+    assert _parse_range("bytes=-100", 1000) == (900, 999)  # Suffix
+    assert _parse_range("bytes=-5000", 1000) == (0, 999)
+
+
+def test_parse_range_served_as_full_response():
+    assert _parse_range("bytes=5-2", 1000) is None  # Reversed
+    assert _parse_range("bytes=0-1,5-9", 1000) is None  # Multiple ranges
+    assert _parse_range("items=0-9", 1000) is None
+    assert _parse_range("bytes=abc-", 1000) is None
+
+
+def test_parse_range_not_satisfiable():
+    _not_satisfiable("bytes=1000-", 1000)
+    _not_satisfiable("bytes=-0", 1000)
+
+
+def test_slice():
+    chunks = [(0, b"abcd"), (4, b"efgh"), (8, b"ij")]
+    assert b"".join(_slice(iter(chunks), 0, 9)) == b"abcdefghij"
+    assert b"".join(_slice(iter(chunks), 3, 5)) == b"def"
+    assert b"".join(_slice(iter(chunks), 8, 8)) == b"i"
+
+    # Stops pulling chunks once the range is complete
+    pulled = []
+
+    def tracked():
+        for chunk in chunks:
+            pulled.append(chunk[0])
+            yield chunk
+
+    assert b"".join(_slice(tracked(), 1, 2)) == b"bc"
+    assert pulled == [0]
+
+
+if __name__ == "__main__":
+    test_parse_range()
+    test_parse_range_served_as_full_response()
+    test_parse_range_not_satisfiable()
+    test_slice()
+    print("SUCCESS: history export tests passed.")
@@ -0,0 +1,128 @@
+import os
+import sys
+import asyncio
+
+from fastapi import HTTPException
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from idempotency import IdempotencyStore, fingerprint
+
+
+def _counting(result="done"):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return result
+
+    return compute, calls
+
+
+def test_replay():
+    async def run():
+        store = IdempotencyStore()
+        compute, calls = _counting({"image": "data:image/png;base64,AAAA"})
+        first = await store.run("key-1", "fp", compute)
+        second = await store.run("key-1", "fp", compute)
+        assert first == ({"image": "data:image/png;base64,AAAA"}, False)
+        assert second == (first[0], True)
+        assert len(calls) == 1
+
+    asyncio.run(run())
+
+
+def test_concurrent_retry_attaches():
+    async def run():
+        store = IdempotencyStore()
+        compute, calls = _counting()
+        results = await asyncio.gather(store.run("key-1", "fp", compute), store.run("key-1", "fp", compute))
+        assert [r[0] for r in results] == ["done", "done"]
+        assert len(calls) == 1
+
+    asyncio.run(run())
+
+
+def test_key_reused_for_other_request():
+    async def run():
+        store = IdempotencyStore()
+        compute, _ = _counting()
+        await store.run("key-1", fingerprint({"prompt": "a"}), compute)
+        try:
+            await store.run("key-1", fingerprint({"prompt": "b"}), compute)
+        except HTTPException as e:
+            assert e.status_code == 422
+        else:
+            raise AssertionError("expected 422 for a different payload")
+
+    asyncio.run(run())
+
+
+def test_failure_not_cached():
+    async def run():
+        store = IdempotencyStore()
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("model unavailable")
+            return "done"
+
+        try:
+            await store.run("key-1", "fp", flaky)
+        except RuntimeError:
+            pass
+        await asyncio.sleep(0)
+        assert await store.run("key-1", "fp", flaky) == ("done", False)
+        assert len(attempts) == 2
+
+    asyncio.run(run())
+
+
+def test_evicts_oldest_by_count():
+    async def run():
+        store = IdempotencyStore(max_entries=2)
+        compute, _ = _counting()
+        for key in ("a", "b", "c"):
+            await store.run(key, "fp", compute)
+        await asyncio.sleep(0)
+        assert list(store._entries) == ["b", "c"]
+
+        # Replaying a stored key keeps everything
+        assert (await store.run("b", "fp", compute))[1]
+        assert list(store._entries) == ["b", "c"]
+
+    asyncio.run(run())
+
+
+def test_evicts_by_bytes():
+    async def run():
+        store = IdempotencyStore(max_bytes=250)
+        for key in ("a", "b", "c"):
+            compute, _ = _counting("x" * 100)
+            await store.run(key, "fp", compute)
+        await asyncio.sleep(0)
+        assert list(store._entries) == ["b", "c"]
+        assert store.stored_bytes == 200
+
+        # A result bigger than the whole cap is returned but not kept
+        compute, _ = _counting("x" * 300)
+        assert await store.run("big", "fp", compute) == ("x" * 300, False)
+        await asyncio.sleep(0)
+        assert "big" not in store._entries
+        assert store.stored_bytes == 200
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_replay()
+    test_concurrent_retry_attaches()
+    test_key_reused_for_other_request()
+    test_failure_not_cached()
+    test_evicts_oldest_by_count()
+    test_evicts_by_bytes()
+    print("SUCCESS: idempotency tests passed.")
@@ -0,0 +1,134 @@
+import os
+import sys
+import asyncio
+
+from fastapi import HTTPException
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from scheduler import FairScheduler, ANON_BURST, MAX_PENDING_PER_PRINCIPAL
+
+
+async def _call(scheduler, principal, order, name, hold=None):
+    async with scheduler.admit(principal) as ticket:
+        async with scheduler.turn(ticket):
+            order.append(name)
+            if hold is not None:
+                await hold.wait()
+
+
+def test_fair_ordering():
+    async def run():
+        scheduler = FairScheduler(concurrency=1)
+        order = []
+        hold = asyncio.Event()
+        busy = asyncio.create_task(_call(scheduler, "user:busy", order, "busy", hold))
+        await asyncio.sleep(0)
+
+        # user:a queues three calls before user:b queues one; b must not wait behind all of a's
+        tasks = [asyncio.create_task(_call(scheduler, "user:a", order, f"a{i}")) for i in range(1, 4)]
+        tasks.append(asyncio.create_task(_call(scheduler, "user:b", order, "b1")))
+        await asyncio.sleep(0)
+
+        hold.set()
+        await asyncio.gather(busy, *tasks)
+        assert order == ["busy", "a1", "b1", "a2", "a3"], order
+        assert scheduler.active == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_hands_slot_on():
+    async def run():
+        scheduler = FairScheduler(concurrency=1)
+        order = []
+        hold = asyncio.Event()
+
+        async def holder():
+            await _call(scheduler, "user:h", order, "h", hold)
+            # Leaving the turn just handed the slot to the waiter; cancel it before it runs
+            waiter.cancel()
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_call(scheduler, "user:w", order, "w"))
+        after = asyncio.create_task(_call(scheduler, "user:x", order, "x"))
+        await asyncio.sleep(0)
+
+        hold.set()
+        await first
+        await asyncio.wait_for(after, timeout=1)
+        assert waiter.cancelled()
+        assert order == ["h", "x"], order
+        assert scheduler.active == 0
+        # The cancelled call never reached the model, so its token was refunded
+        assert scheduler._buckets["user:w"].is_full()
+
+    asyncio.run(run())
+
+
+def test_failed_before_turn_is_refunded():
+    async def run():
+        scheduler = FairScheduler(concurrency=1)
+        try:
+            async with scheduler.admit("user:a"):
+                raise ValueError("no face")
+        except ValueError:
+            pass
+        assert scheduler._buckets["user:a"].is_full()
+        assert "user:a" not in scheduler._pending
+
+    asyncio.run(run())
+
+
+def test_quota_exceeded():
+    async def run():
+        scheduler = FairScheduler(concurrency=1)
+        for _ in range(int(ANON_BURST)):
+            async with scheduler.admit("ip:1.2.3.4", anonymous=True) as ticket:
+                async with scheduler.turn(ticket):
+                    pass
+        try:
+            async with scheduler.admit("ip:1.2.3.4", anonymous=True):
+                pass
+        except HTTPException as e:
+            assert e.status_code == 429
+            assert int(e.headers["Retry-After"]) >= 1
+        else:
+            raise AssertionError("expected 429 once the burst is used up")
+
+    asyncio.run(run())
+
+
+def test_too_many_pending():
+    async def run():
+        scheduler = FairScheduler(concurrency=1)
+        hold = asyncio.Event()
+        order = []
+        tasks = [
+            asyncio.create_task(_call(scheduler, "user:a", order, i, hold))
+            for i in range(MAX_PENDING_PER_PRINCIPAL)
+        ]
+        await asyncio.sleep(0)
+        try:
+            async with scheduler.admit("user:a"):
+                pass
+        except HTTPException as e:
+            assert e.status_code == 429
+        else:
+            raise AssertionError("expected 429 past MAX_PENDING_PER_PRINCIPAL")
+        hold.set()
+        await asyncio.gather(*tasks)
+        assert not scheduler._pending
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_fair_ordering()
+    test_cancelled_waiter_hands_slot_on()
+    test_failed_before_turn_is_refunded()
+    test_quota_exceeded()
+    test_too_many_pending()
+    print("SUCCESS: scheduler tests passed.")
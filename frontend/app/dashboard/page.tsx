@@ -27,6 +27,30 @@ const MATERIALS = [
   { id: 'allon4', name: 'İmplant Üstü Zirkonyum (All-on-4)', prompt: 'Fixed prosthesis, pink gum architecture integration, perfectly aligned artificial gum line, white zirconium teeth.' },
 ];
 
+const DESIGN_TIMEOUT_MS = 120_000;
+const DESIGN_RETRIES = 2;
+
+// crypto.randomUUID only exists in secure contexts (https / localhost); getRandomValues works everywhere
+function newIdempotencyKey(): string {
+  if (typeof crypto.randomUUID === 'function') return crypto.randomUUID();
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  return Array.from(bytes, (b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Retries on timeouts, network errors and gateway/overload responses. Callers pass the same
+// Idempotency-Key for every try, so the server attaches to the running call instead of starting another.
+async function fetchWithRetry(url: string, init: RequestInit): Promise<Response> {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const response = await fetch(url, { ...init, signal: AbortSignal.timeout(DESIGN_TIMEOUT_MS) });
+      if (![502, 503, 504].includes(response.status) || attempt >= DESIGN_RETRIES) return response;
+    } catch (error) {
+      if (attempt >= DESIGN_RETRIES) throw error;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 2000 * 2 ** attempt));
+  }
+}
+
 export default function Dashboard() {
   const router = useRouter();
   const [user, setUser] = useState<User | null>(null);
@@ -42,6 +66,8 @@ export default function Dashboard() {
   const [expertNotes, setExpertNotes] = useState('');
   const [isProcessing, setIsProcessing] = useState(false);
   const [processingStage, setProcessingStage] = useState('');
+  // Idempotency-Key of the current design attempt; kept until it succeeds or its inputs change
+  const designKey = useRef<string | null>(null);
 
   useEffect(() => {
     const token = localStorage.getItem('token');
@@ -95,65 +121,39 @@ export default function Dashboard() {
     reader.readAsDataURL(file);
     
     // Reset states
+    const idempotencyKey = newIdempotencyKey();
+    designKey.current = idempotencyKey;
     setMaskedImage(null);
     setGeneratedImage(null);
     setIsProcessing(true);
     setProcessingStage('Yüz taranıyor ve analiz ediliyor...');
 
     try {
-        const formData = new FormData();
-        formData.append('file', file);
         const apiUrl = process.env.NEXT_PUBLIC_API_URL ?? 'http://localhost:8000';
-        
-        // Step 1: Generate Mask
-        const maskResponse = await fetch(`${apiUrl}/generate-mask`, {
-            method: 'POST',
-            body: formData,
-        });
-
-        if (!maskResponse.ok) throw new Error('Maskeleme başarısız.');
-        const maskData = await maskResponse.json();
-        const newMaskedImage = `data:image/png;base64,${maskData.mask}`;
-        setMaskedImage(newMaskedImage);
-
-        // Step 2: Auto-Generate Smile
-        setProcessingStage('Google Vertex AI ile yeni gülüş tasarlanıyor...');
-        
         const token = localStorage.getItem('token');
         const materialPrompt = MATERIALS.find(m => m.id === selectedMaterial)?.prompt;
 
-        // Use the newly read image data directly or wait for state? 
-        // Better to use the file reader result or just pass the file again?
-        // Actually, we need the base64 string for the API.
-        // Since FileReader is async, let's wait for it or use a promise wrapper.
-        // A simpler way: we already have the file, let's read it to base64 synchronously-ish or just wait.
-        
-        // Let's use a helper to get base64 from file to be sure
-        const toBase64 = (file: File) => new Promise<string>((resolve, reject) => {
-            const reader = new FileReader();
-            reader.readAsDataURL(file);
-            reader.onload = () => resolve(reader.result as string);
-            reader.onerror = error => reject(error);
-        });
-
-        const base64Image = await toBase64(file);
+        // Masking and generation run server-side in one request
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('return_mask', 'true');
+        if (materialPrompt) formData.append('style_prompt', materialPrompt);
+        if (expertNotes) formData.append('expert_prompt', expertNotes);
 
-        const response = await fetch(`${apiUrl}/generate-smile`, {
+        const response = await fetchWithRetry(`${apiUrl}/design`, {
             method: 'POST',
-            headers: { 
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${token}`
+            headers: {
+                'Authorization': `Bearer ${token}`,
+                // One key per design attempt so retried requests don't run the model twice
+                'Idempotency-Key': idempotencyKey
             },
-            body: JSON.stringify({
-                image: base64Image,
-                mask: newMaskedImage,
-                style_prompt: materialPrompt,
-                expert_prompt: expertNotes
-            }),
+            body: formData,
         });
 
         if (!response.ok) throw new Error('Üretim başarısız.');
         const data = await response.json();
+        designKey.current = null;
+        setMaskedImage(`data:image/png;base64,${data.mask}`);
         setGeneratedImage(data.image_url);
         
         // Refresh history
@@ -178,17 +178,22 @@ export default function Dashboard() {
 
     setIsProcessing(true);
     setProcessingStage('Google Vertex AI ile gülüş tasarlanıyor...');
+    // A failed attempt keeps its key, so clicking again attaches to a call that is still running
+    const idempotencyKey = designKey.current || newIdempotencyKey();
+    designKey.current = idempotencyKey;
 
     try {
         const apiUrl = process.env.NEXT_PUBLIC_API_URL ?? 'http://localhost:8000';
         const token = localStorage.getItem('token');
         const materialPrompt = MATERIALS.find(m => m.id === selectedMaterial)?.prompt;
 
-        const response = await fetch(`${apiUrl}/generate-smile`, {
+        const response = await fetchWithRetry(`${apiUrl}/generate-smile`, {
             method: 'POST',
             headers: { 
                 'Content-Type': 'application/json',
-                'Authorization': `Bearer ${token}`
+                'Authorization': `Bearer ${token}`,
+                // One key per design attempt so retried requests don't run the model twice
+                'Idempotency-Key': idempotencyKey
             },
             body: JSON.stringify({
                 image: selectedImage,
@@ -200,6 +205,7 @@ export default function Dashboard() {
 
         if (!response.ok) throw new Error('Üretim başarısız.');
         const data = await response.json();
+        designKey.current = null;
         setGeneratedImage(data.image_url);
         
         // Refresh history
@@ -359,7 +365,7 @@ export default function Dashboard() {
                                         {MATERIALS.map((mat) => (
                                             <button
                                                 key={mat.id}
-                                                onClick={() => setSelectedMaterial(mat.id)}
+                                                onClick={() => { setSelectedMaterial(mat.id); designKey.current = null; }}
                                                 className={`w-full text-left p-3 rounded-xl border transition-all ${selectedMaterial === mat.id ? 'bg-blue-600/20 border-blue-500 text-white' : 'bg-black/20 border-transparent text-slate-400 hover:bg-white/5'}`}
                                             >
                                                 <div className="font-medium text-sm">{mat.name}</div>
@@ -372,7 +378,7 @@ export default function Dashboard() {
                                     <label className="block text-sm font-medium text-slate-300 mb-3">Hekim/Teknisyen Notları (Opsiyonel)</label>
                                     <textarea
                                         value={expertNotes}
-                                        onChange={(e) => setExpertNotes(e.target.value)}
+                                        onChange={(e) => { setExpertNotes(e.target.value); designKey.current = null; }}
                                         placeholder="Örn: Kanin dişleri biraz daha sivri olsun, A1 renk kodu..."
                                         className="w-full bg-black/40 border border-white/10 rounded-xl p-3 text-sm text-white placeholder:text-slate-600 focus:outline-none focus:border-blue-500 min-h-[100px]"
                                     />